@@ -0,0 +1,210 @@
+
+# =======================================================
+# A compact table of accounts
+# =======================================================
+
+# =================
+# accounttable.py
+# =================
+
+# Every Account is a Python object, and its balance is another one (an int object).
+# With millions of accounts in memory (for risk checks, say) those objects use most of the memory.
+
+# AccountTable keeps everything in a few flat arrays instead of one object per account:
+#   _balances  array('q')  the balances in cents, 8 bytes each, no int objects
+#   _names     bytearray   all the names, UTF-8 encoded, one after the other
+#   _ends      array('q')  where each name ends in _names (name i is _names[_ends[i - 1]:_ends[i]])
+#   _slots     array('i')  a hash table from name to position ("open addressing": a name's hash picks a slot,
+#                          and if that slot is taken by another name we try the next one). -1 is an empty slot
+# A dict of name -> position would be simpler, but the dict and the str objects for the names
+# would then be most of the table again (about 100 bytes per account). This way an account costs
+# its name's bytes plus about 25 bytes: about 40 bytes for a name like "Account-123456", where an Account
+# object with a __dict__ needs about 200 (run this file to compare). Looking a name up is slower than
+# a dict (it's done in Python), which is fine for risk checks that read every balance in order.
+
+# table["John"] gives an AccountView: a tiny object that only holds the table and a position.
+# Views have the same deposit(), withdraw() and show_balance() as Account (they ARE Account's methods,
+# see below), so they save to the database, roll back and use the pool's balance cache in exactly the same way.
+# Views are made when we ask for them and can be thrown away, the table is what stays in memory.
+
+#   table = AccountTable.load(pool)            # every account in the database
+#   table["John"].deposit(1000)
+#   sum(table.balances())                     # no Python objects made for the accounts
+#   risky = [name for name, balance in table.items() if balance < 1000]
+
+from array import array
+
+from connpool import ConnectionPool
+from rollback7 import Account, default_pool
+
+
+class AccountView(object):
+
+    __slots__ = ("_table", "_index")
+
+    def __init__(self, table, index: int):
+        self._table = table
+        self._index = index
+
+    @property
+    def name(self) -> str:
+        return self._table.name(self._index)
+
+    @property
+    def _balance(self) -> int:
+        return self._table._balances[self._index]
+
+    @_balance.setter
+    def _balance(self, balance: int):
+        self._table._balances[self._index] = balance
+
+    @property
+    def _pool(self) -> ConnectionPool:
+        return self._table.pool
+
+    # Account's methods only use name, _balance and _pool, so the view can borrow them
+    deposit = Account.deposit
+    withdraw = Account.withdraw
+    _withdraw = Account._withdraw
+    _save_update = Account._save_update
+    _save = Account._save
+    show_balance = Account.show_balance
+
+    def __repr__(self):
+        return "AccountView({!r}, {})".format(self.name, self._balance)
+
+
+class AccountTable(object):
+
+    def __init__(self, pool: ConnectionPool = None, capacity: int = 1024):
+        self.pool = pool if pool is not None else default_pool
+        self._balances = array("q")   # signed 64 bit integers
+        self._names = bytearray()
+        self._ends = array("q")
+        self._slots = array("i", [-1]) * _table_size(capacity)  # 32 bit positions, up to 2**31 accounts
+        self._mask = len(self._slots) - 1
+
+    # Every account in the pool's database
+    @classmethod
+    def load(cls, pool: ConnectionPool = None, batch_size: int = 100000):
+        table = cls(pool)
+        table.refresh(batch_size)
+        return table
+
+    # Reads all the balances again (other processes may have changed them), and adds any new accounts
+    def refresh(self, batch_size: int = 100000):
+        cursor = self.pool.reader().execute("SELECT name, balance FROM accounts")
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                return
+            for name, balance in rows:
+                self._add(name, balance)
+
+    # The slot that holds "encoded", or the empty slot where it would go
+    def _slot(self, encoded: bytes) -> int:
+        slots, names, ends, mask = self._slots, self._names, self._ends, self._mask
+        slot = hash(encoded) & mask
+        while True:
+            index = slots[slot]
+            if index < 0 or names[(ends[index - 1] if index else 0):ends[index]] == encoded:
+                return slot
+            slot = (slot + 1) & mask
+
+    def _find(self, name: str) -> int:
+        return self._slots[self._slot(name.encode("utf-8"))]
+
+    def _add(self, name: str, balance: int) -> int:
+        encoded = name.encode("utf-8")
+        slot = self._slot(encoded)
+        index = self._slots[slot]
+        if index >= 0:
+            self._balances[index] = balance
+            return index
+        index = len(self._balances)
+        self._slots[slot] = index
+        self._names += encoded
+        self._ends.append(len(self._names))
+        self._balances.append(balance)
+        if 2 * len(self._balances) > len(self._slots):
+            self._grow()  # keep the table at most half full, so lookups only try a slot or two
+        return index
+
+    def _grow(self):
+        self._slots = array("i", [-1]) * (2 * len(self._slots))
+        self._mask = len(self._slots) - 1
+        for index in range(len(self._balances)):
+            self._slots[self._slot(self._encoded(index))] = index
+
+    def _encoded(self, index: int) -> bytes:
+        return bytes(self._names[(self._ends[index - 1] if index else 0):self._ends[index]])
+
+    def name(self, index: int) -> str:
+        return self._encoded(index).decode("utf-8")
+
+    # Opens (or retrieves) accounts from a list of (name, opening_balance), like Account.load_many
+    def open_many(self, names_with_opening_balances: list) -> list:
+        return [AccountView(self, self._add(account.name, account._balance))
+                for account in Account.load_many(names_with_opening_balances, self.pool)]
+
+    def open(self, name: str, opening_balance: int = 0) -> AccountView:
+        return self.open_many([(name, opening_balance)])[0]
+
+    def __len__(self) -> int:
+        return len(self._balances)
+
+    def __contains__(self, name: str) -> bool:
+        return self._find(name) >= 0
+
+    def __getitem__(self, name: str) -> AccountView:
+        index = self._find(name)
+        if index < 0:
+            raise KeyError(name)
+        return AccountView(self, index)
+
+    def __iter__(self):
+        return (AccountView(self, index) for index in range(len(self._balances)))
+
+    def balance(self, name: str) -> int:
+        return self[name]._balance
+
+    def balances(self) -> array:
+        return self._balances
+
+    def items(self):
+        return ((self.name(index), balance) for index, balance in enumerate(self._balances))
+
+
+# The smallest power of 2 that is at least twice "capacity"
+def _table_size(capacity: int) -> int:
+    size = 8
+    while size < 2 * capacity:
+        size *= 2
+    return size
+
+
+if __name__ == '__main__':
+    import sys
+    import tracemalloc
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+    tracemalloc.start()
+    accounts = []
+    for i in range(count):
+        account = Account.__new__(Account)
+        account.name, account._balance, account._pool = "Account-{}".format(i), 100000 + i, default_pool
+        accounts.append(account)
+    objects = tracemalloc.get_traced_memory()[0]
+    del accounts
+
+    before = tracemalloc.get_traced_memory()[0]
+    table = AccountTable()
+    for i in range(count):
+        table._add("Account-{}".format(i), 100000 + i)
+    compact = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    print("{} Account objects: {:.1f} MB".format(count, objects / 1e6))
+    print("AccountTable:         {:.1f} MB".format(compact / 1e6))
+    print("Total of all balances: {:.2f}".format(sum(table.balances()) / 100))
@@ -0,0 +1,110 @@
+
+# =======================================================
+# Async (asyncio) Account
+# =======================================================
+
+# =================
+# asyncaccount.py
+# =================
+
+# Calling Account.deposit() or withdraw() from a coroutine blocks the whole event loop while SQLite writes and fsyncs.
+# AsyncAccount wraps a rollback7.Account and runs the SQLite work on a dedicated executor instead:
+
+#   john = await AsyncAccount.open("John")
+#   await john.deposit(1010)
+#   await john.withdraw(30)
+#   await john.balance()
+
+# The executor has ONE thread by default. The pool only has one writer anyway, so more threads would just wait
+# for each other. Thousands of coroutines can be waiting at once, but they don't each need a thread.
+# _save_update is called as before, so the try/rollback/commit rules are the same as in rollback7.py.
+
+# If you give AsyncAccount a GroupCommitWriter (see groupcommit.py), deposits and withdrawals go to the writer
+# thread instead, and all the waiting coroutines share its commits.
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from connpool import ConnectionPool
+from groupcommit import GroupCommitWriter
+from rollback7 import Account, _events
+
+_executor = None
+
+
+def default_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+    return _executor
+
+
+class AsyncAccount(object):
+
+    def __init__(self, account: Account, executor: ThreadPoolExecutor = None, writer: GroupCommitWriter = None):
+        self.account = account
+        self._executor = executor if executor is not None else default_executor()
+        self._writer = writer
+
+    @classmethod
+    async def open(cls, name: str, opening_balance: int = 0, pool: ConnectionPool = None,
+                   executor: ThreadPoolExecutor = None, writer: GroupCommitWriter = None) -> "AsyncAccount":
+        executor = executor if executor is not None else default_executor()
+        account = await cls._run(executor, Account, name, opening_balance, pool)
+        return cls(account, executor, writer)
+
+    @property
+    def name(self) -> str:
+        return self.account.name
+
+    # Only called from our coroutines, so there is always a running loop
+    @staticmethod
+    def _run(executor: ThreadPoolExecutor, function, *args):
+        return asyncio.get_running_loop().run_in_executor(executor, function, *args)
+
+    async def deposit(self, amount: int) -> float:
+        if self._writer is None:
+            return await self._run(self._executor, self.account.deposit, amount)
+
+        if await asyncio.wrap_future(self._writer.deposit(self.account, amount)):
+            _events(self.account._pool).emit("deposited", self.account.name, amount, self.account._balance)
+        return self.account._balance / 100
+
+    async def withdraw(self, amount: int) -> float:
+        if self._writer is None:
+            return await self._run(self._executor, self.account.withdraw, amount)
+
+        events = _events(self.account._pool)
+        if await asyncio.wrap_future(self._writer.withdraw(self.account, amount)):
+            events.emit("withdrawn", self.account.name, amount, self.account._balance)
+            return amount / 100
+        events.emit("refused", self.account.name, amount, self.account._balance)
+        return 0.0
+
+    # Reads the balance again (from the pool's balance cache, or the database if another process changed it)
+    async def balance(self) -> float:
+        return await self._run(self._executor, self._refresh_balance)
+
+    def _refresh_balance(self) -> float:
+        pool = self.account._pool
+        with pool.writing() as db:
+            pool.balances.validate(db)
+            self.account._balance = pool.balances.load(db, self.account.name)
+        return self.account._balance / 100
+
+
+async def main():
+    john = await AsyncAccount.open("John")
+    await john.deposit(1010)
+    await asyncio.gather(*(john.deposit(10) for _ in range(10)))
+    await john.withdraw(30)
+    print("Balance on account {} is {:.2f}".format(john.name, await john.balance()))
+
+    with GroupCommitWriter(max_ops=1000, max_delay_ms=5) as writer:
+        graham = await AsyncAccount.open("Graham", 9000, writer=writer)
+        await asyncio.gather(*(graham.deposit(1) for _ in range(1000)))
+    print("Balance on account {} is {:.2f}".format(graham.name, await graham.balance()))
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,78 @@
+
+# =======================================================
+# Shared balance cache
+# =======================================================
+
+# =================
+# balancecache.py
+# =================
+
+# Account.__init__ runs "SELECT name, balance FROM accounts WHERE (name = ?)" every time an Account is created,
+# and two Account("John") objects (maybe in different processes) keep their own _balance that can go out of date.
+
+# BalanceCache keeps the balances of the most recently used accounts (an LRU keyed by account name).
+#   - _save_update writes the new balance into the cache after it commits (write-through)
+#   - "PRAGMA data_version" changes when ANOTHER connection (another pool, another process) commits to the file.
+#     When we see it change, we throw the whole cache away, because we don't know what the other connection changed.
+
+# Every method must be called while holding the pool's writer ("with pool.writing() as db:"),
+# and validate() must be called with the writer connection, because data_version is different for each connection.
+
+import sqlite3
+from collections import OrderedDict
+
+from statements import STATEMENTS
+
+
+class BalanceCache(object):
+
+    def __init__(self, maxsize: int = 10000):
+        self.maxsize = maxsize
+        self._balances = OrderedDict()
+        self._data_version = None
+
+    def __len__(self):
+        return len(self._balances)
+
+    # Clears the cache if another connection has committed since we last looked
+    def validate(self, connection: sqlite3.Connection):
+        data_version = connection.execute("PRAGMA data_version").fetchone()[0]
+        if data_version != self._data_version:
+            self._balances.clear()
+            self._data_version = data_version
+
+    def get(self, name: str):
+        balance = self._balances.get(name)
+        if balance is not None:
+            self._balances.move_to_end(name)
+        return balance
+
+    def put(self, name: str, balance: int):
+        self._balances[name] = balance
+        self._balances.move_to_end(name)
+        if len(self._balances) > self.maxsize:
+            self._balances.popitem(last=False)  # forget the least recently used account
+
+    # Returns the cached balance, or reads it from the database (and caches it). None if there is no such account.
+    def load(self, connection: sqlite3.Connection, name: str):
+        balance = self.get(name)
+        if balance is None:
+            row = connection.execute(STATEMENTS["select_balance"], (name,)).fetchone()
+            if row is None:
+                return None
+            balance = row[0]
+            self.put(name, balance)
+        return balance
+
+    # Like load(), but raises KeyError if there is no such account (in this pool's database)
+    def require(self, connection: sqlite3.Connection, name: str) -> int:
+        balance = self.load(connection, name)
+        if balance is None:
+            raise KeyError("No account named {!r} in this database".format(name))
+        return balance
+
+    def discard(self, name: str):
+        self._balances.pop(name, None)
+
+    def clear(self):
+        self._balances.clear()
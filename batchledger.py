@@ -0,0 +1,198 @@
+
+# =======================================================
+# Batching deposits and withdrawals
+# =======================================================
+
+# ================
+# batchledger.py
+# ================
+
+# In rollback7.py every deposit and withdrawal runs one UPDATE, one INSERT and one db.commit()
+# Each commit is one fsync, so we can only do a few hundred operations per second.
+
+# BatchLedger collects many deposits and withdrawals (for many accounts) and saves them all in ONE transaction.
+# The "history" rows and the "accounts" balances are written with executemany.
+
+# We keep the same rollback rules as rollback7._save_update:
+# If one operation hits the (time, account) IntegrityError, only that operation is lost (thanks to savepoints.py)
+# and the _balance of every Account object stays the same as the balance in the database.
+
+import sqlite3
+
+from connpool import ConnectionPool
+from rollback7 import Account, default_pool
+from savepoints import savepoint
+
+
+# apply_batch saves a list of (account, amount, time) tuples in one transaction on the pool's writer.
+# It returns a list of True/False values, one for each operation, telling us if it was saved.
+# Like rollback7._save_update, it takes the write lock with BEGIN IMMEDIATE and starts from the balances
+# in the pool's BalanceCache, so a stale _balance can't approve a withdrawal.
+
+# keys is an optional list with a key (a string) or None for each operation. The key and the result are saved
+# in operation_keys in the same transaction, and an operation whose key is already there is not run again:
+# its result is the one that was saved the first time.
+def apply_batch(pool: ConnectionPool, operations: list, keys: list = None) -> list:
+    keys = keys if keys is not None else [None] * len(operations)
+    with pool.writing() as connection:
+        zone_id = pool.schema["zones"].intern(connection)
+        if any(key is not None for key in keys):
+            pool.schema["keys"].prune(connection)
+        return _apply(pool, connection, operations, keys, zone_id)
+
+
+# The history rows are first written with one executemany, inside a savepoint (see savepoints.py).
+# If one of them already exists (IntegrityError) we don't know which one, so we go back to the savepoint,
+# which keeps the transaction and the write lock, and save the operations one at a time,
+# each in its own savepoint. A failing operation then only undoes itself and we just skip it.
+# The balances are worked out without the lost operations, so a later withdrawal can't overdraw the account.
+def _apply(pool: ConnectionPool, connection: sqlite3.Connection, operations: list, keys: list, zone_id: int) -> list:
+    balance_cache = pool.balances
+    accounts = {}   # account name -> Account objects to update after the commit
+
+    try:
+        connection.execute("BEGIN IMMEDIATE")
+        balance_cache.validate(connection)
+        start = {}  # account name -> balance before the batch
+        for account, _, _ in operations:
+            if account.name not in start:
+                start[account.name] = balance_cache.require(connection, account.name)
+            accounts.setdefault(account.name, []).append(account)
+        try:
+            with savepoint(connection):
+                balances, applied = _stage(pool, connection, operations, keys, zone_id, dict(start),
+                                           one_by_one=False)
+        except sqlite3.IntegrityError:
+            pool.schema["snapshots"].forget(start)  # the fast pass's checkpoints were undone too
+            balances, applied = _stage(pool, connection, operations, keys, zone_id, dict(start), one_by_one=True)
+        pool.statements.executemany("update_balance", [(balance, name) for name, balance in balances.items()])
+    except sqlite3.Error:
+        connection.rollback()
+        pool.schema["snapshots"].forget(accounts)
+        return [False] * len(operations)
+    except BaseException:
+        connection.rollback()  # not a database error: undo, and let it go on up
+        pool.schema["snapshots"].forget(accounts)
+        raise
+    else:
+        connection.commit()
+        # _balance (and the cache) are only changed after the commit, just like in rollback7._save_update
+        for name, balance in balances.items():
+            balance_cache.put(name, balance)
+            for account in accounts[name]:
+                account._balance = balance
+        return applied
+
+
+# Writes the history rows, snapshots and operation keys.
+# Returns (new balances, list of True/False for each operation)
+def _stage(pool: ConnectionPool, connection: sqlite3.Connection, operations: list, keys: list, zone_id: int,
+           balances: dict, one_by_one: bool) -> tuple:
+    snapshots = pool.schema["snapshots"]
+    operation_keys = pool.schema["keys"]
+    statements = pool.statements  # the named statements on the writer, which is "connection"
+    history_rows = []
+    key_rows = []
+    applied = []
+    for (account, amount, op_time), key in zip(operations, keys):
+        name = account.name
+        if one_by_one and key is not None:
+            done = operation_keys.lookup(connection, key)
+            if done is not None:
+                applied.append(done)  # done before, don't do it again
+                continue
+        if balances[name] + amount < 0:
+            applied.append(False)  # withdrawal would overdraw the account
+            if key is not None and one_by_one:
+                operation_keys.save(connection, key, False)
+            elif key is not None:
+                key_rows.append((key, 0))
+            continue
+        if one_by_one:
+            try:
+                with savepoint(connection):
+                    statements.execute("insert_history", (op_time, name, amount, zone_id))
+                    if key is not None:
+                        operation_keys.save(connection, key, True)
+                    snapshots.record(connection, name, op_time, balances[name] + amount)
+            except sqlite3.IntegrityError:
+                snapshots.forget([name])
+                applied.append(False)  # only this operation is lost
+                continue
+        else:
+            history_rows.append((op_time, name, amount, zone_id))
+            if key is not None:
+                key_rows.append((key, 1))
+            snapshots.record(connection, name, op_time, balances[name] + amount)
+        balances[name] += amount
+        applied.append(True)
+    statements.executemany("insert_history", history_rows)
+    operation_keys.save_many(connection, key_rows)
+    return balances, applied
+
+
+class BatchLedger(object):
+
+    def __init__(self, pool: ConnectionPool = None, max_batch: int = 1000):
+        self._pool = pool if pool is not None else default_pool
+        self.max_batch = max_batch  # commit automatically when this many operations are waiting
+        self._pending = []          # list of (account, amount, time)
+        self._balances = {}         # account name -> balance including the pending operations
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.discard()
+
+    def _pending_balance(self, account: Account) -> int:
+        return self._balances.get(account.name, account._balance)
+
+    def _queue(self, account: Account, amount: int):
+        op_time = Account._current_time(account.name, self._pool.schema["time_format"])
+        self._pending.append((account, amount, op_time))
+        self._balances[account.name] = self._pending_balance(account) + amount
+        if len(self._pending) >= self.max_batch:
+            self.commit()
+
+    def deposit(self, account: Account, amount: int) -> bool:
+        if amount > 0:
+            self._queue(account, amount)
+            return True
+        return False
+
+    def withdraw(self, account: Account, amount: int) -> bool:
+        if 0 < amount <= self._pending_balance(account):
+            self._queue(account, -amount)
+            return True
+        return False
+
+    # Saves all the pending operations in one transaction
+    def commit(self) -> list:
+        operations, self._pending, self._balances = self._pending, [], {}
+        if not operations:
+            return []
+        return apply_batch(self._pool, operations)
+
+    # Forgets the pending operations without touching the database
+    def discard(self):
+        self._pending, self._balances = [], {}
+
+
+if __name__ == '__main__':
+    john = Account("John")
+    graham = Account("Graham", 9000)
+
+    with BatchLedger() as ledger:
+        ledger.deposit(john, 1010)
+        ledger.deposit(graham, 10)
+        ledger.withdraw(john, 30)
+        ledger.withdraw(graham, 50000)  # refused, more than the balance
+
+    john.show_balance()
+    graham.show_balance()
+
+    default_pool.close()
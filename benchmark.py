@@ -0,0 +1,269 @@
+
+# =======================================================
+# Benchmarking the Account versions
+# =======================================================
+
+# ==============
+# benchmark.py
+# ==============
+
+# We have many versions of Account (rollback.py ... rollback7.py, rollback_Ref.py, rollbackTrainer*.py)
+# and until now no numbers for any of them. benchmark.py measures, for each version:
+#   create    - Account(name, opening_balance) for a new account
+#   deposit   - account.deposit(amount)
+#   withdraw  - account.withdraw(amount)
+#   scan      - reading the whole history table, and one account's history
+# with the history table holding 1K, 100K and 10M rows (the rows are added straight into the table,
+# because adding 10M rows with deposit() would take hours), and for every journal_mode / synchronous setting.
+
+# Each version is run in its own process, in its own temporary directory, because most of them
+# open "accounts.sqlite" in the current directory as soon as they are imported.
+# The versions without a database (rollback.py, rollback2.py, ...) only get create/deposit/withdraw.
+
+# For every measurement we save ops/sec and the p50 and p99 latency (in milliseconds) to a JSON file,
+# so a later run can be compared with it:
+
+#   python benchmark.py --output before.json
+#   ... change something ...
+#   python benchmark.py --output after.json --compare before.json
+#   python benchmark.py --variants rollback7 --rows 1000,100000 --ops 500
+
+import argparse
+import contextlib
+import datetime
+import importlib
+import inspect
+import io
+import json
+import math
+import multiprocessing
+import os
+import platform
+import sqlite3
+import sys
+import tempfile
+import time
+
+VARIANTS = ("rollback", "rollback2", "rollback3", "rollback4", "rollback4_Ref", "rollback5", "rollback6",
+            "rollback7", "rollback_Ref", "rollbackTrainer", "rollbackTrainer2")
+ROWS = (1000, 100000, 10000000)
+JOURNAL_MODES = ("DELETE", "WAL")
+SYNCHRONOUS = ("OFF", "NORMAL", "FULL")
+
+_ACCOUNTS = 100  # the seeded history rows are spread over this many accounts
+_SEED_CHUNK = 100000
+_SEED_START = datetime.datetime(2000, 1, 1)  # seeded rows are long before any real operation
+
+
+# p50 / p99 by the "nearest rank" method, in milliseconds
+def percentile(latencies: list, fraction: float) -> float:
+    ordered = sorted(latencies)
+    rank = max(0, min(len(ordered) - 1, math.ceil(fraction * len(ordered)) - 1))  # the smallest covering fraction
+    return ordered[rank] * 1000
+
+
+def _measure(operation, count: int) -> dict:
+    latencies = []
+    started = time.perf_counter()
+    for i in range(count):
+        before = time.perf_counter()
+        operation(i)
+        latencies.append(time.perf_counter() - before)
+    elapsed = time.perf_counter() - started
+    return {"ops": count, "seconds": elapsed, "ops_per_sec": count / elapsed if elapsed else None,
+            "p50_ms": percentile(latencies, 0.50), "p99_ms": percentile(latencies, 0.99)}
+
+
+# The name of the history table, or None for the versions without a database
+def _history_table(db: sqlite3.Connection):
+    tables = {row[0] for row in db.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    for name in ("history", "transactions"):
+        if name in tables:
+            return name
+    return None
+
+
+# Adds rows to the history table until it has "rows" rows.
+# The time column gets values of the same type the version uses (ISO text, or integer microseconds).
+def _seed(db: sqlite3.Connection, table: str, rows: int):
+    existing = db.execute("SELECT COUNT(*) FROM {}".format(table)).fetchone()[0]
+    integer_time = any(column[1] == "time" and column[2].upper() == "INTEGER"
+                       for column in db.execute("PRAGMA table_info({})".format(table)))
+    db.executemany("INSERT OR IGNORE INTO accounts VALUES(?, 0)",
+                   [("seed-{}".format(account),) for account in range(_ACCOUNTS)])
+    db.commit()
+    for start in range(existing, rows, _SEED_CHUNK):
+        batch = []
+        for i in range(start, min(rows, start + _SEED_CHUNK)):
+            moment = _SEED_START + datetime.timedelta(microseconds=i)
+            batch.append((int(moment.timestamp() * 1000000) if integer_time else moment.isoformat(" ") + "+00:00",
+                          "seed-{}".format(i % _ACCOUNTS), 1))
+        db.executemany("INSERT INTO {} (time, account, amount) VALUES(?, ?, ?)".format(table), batch)
+        db.commit()
+
+
+def _scan(db: sqlite3.Connection, table: str, rows: int) -> dict:
+    results = {}
+    results["scan"] = _measure(lambda i: sum(1 for _ in db.execute("SELECT * FROM {}".format(table))), 3)
+    results["scan"]["rows_read"] = rows
+    results["account_scan"] = _measure(lambda i: db.execute("SELECT * FROM {} WHERE (account = ?)".format(table),
+                                                            ("seed-{}".format(i % _ACCOUNTS),)).fetchall(), 10)
+    results["account_scan"]["rows_read"] = rows // _ACCOUNTS
+    return results
+
+
+# Runs in the child process, inside the temporary directory
+def _run_variant(variant: str, rows: list, ops: int, journal_modes: list, synchronous: list) -> list:
+    results = []
+
+    def record(size, journal_mode, sync, measured: dict):
+        for operation, numbers in measured.items():
+            results.append(dict(variant=variant, rows=size, journal_mode=journal_mode, synchronous=sync,
+                                operation=operation, **numbers))
+
+    with contextlib.redirect_stdout(io.StringIO()):  # the Account methods print on every call
+        module = importlib.import_module(variant)
+        account_class = module.Account
+        uses_pool = "pool" in inspect.signature(account_class.__init__).parameters
+        if uses_pool:
+            from connpool import ConnectionPool
+            module.default_pool.close()
+        db = getattr(module, "db", None)
+
+        def open_pool(journal_mode, sync):
+            pool = ConnectionPool("accounts.sqlite", journal_mode=journal_mode, synchronous=sync,
+                                  on_create=module.create_schema)
+            return pool, lambda *arguments: account_class(*arguments, pool=pool)
+
+        if uses_pool:
+            pool, new_account = open_pool("WAL", "NORMAL")
+            db = pool.writer
+        else:
+            new_account = account_class
+        table = _history_table(db) if db is not None else None
+
+        if table is None:
+            # no database: only the Python side can be measured
+            john = new_account("John", ops * 10)
+            record(0, None, None, {"create": _measure(lambda i: new_account("Create-{}".format(i), 100), ops),
+                                   "deposit": _measure(lambda i: john.deposit(10), ops),
+                                   "withdraw": _measure(lambda i: john.withdraw(10), ops)})
+            return results
+
+        for size in sorted(rows):
+            # seeding and scans use a plain connection of our own, so every version is read the same way
+            # (rollback6.py's detect_types can't read back its own aware timestamps).
+            # It is closed again before the sweep, because leaving WAL mode needs the only open connection.
+            if uses_pool:
+                db = pool.writer
+            if db.in_transaction:
+                db.commit()  # rollback3.py forgets the () on commit
+            raw = sqlite3.connect("accounts.sqlite")
+            _seed(raw, table, size)
+            record(size, None, None, _scan(raw, table, size))
+            raw.close()
+            for journal_mode in journal_modes:
+                for sync in synchronous:
+                    if uses_pool:
+                        pool.close()
+                        pool, new_account = open_pool(journal_mode, sync)
+                    else:
+                        if db.in_transaction:
+                            db.commit()
+                        db.execute("PRAGMA journal_mode = {}".format(journal_mode))
+                        db.execute("PRAGMA synchronous = {}".format(sync))
+                    prefix = "{}-{}-{}".format(size, journal_mode, sync)
+                    john = new_account("John-" + prefix, ops * 10)
+                    record(size, journal_mode, sync, {
+                        "create": _measure(lambda i: new_account("Create-{}-{}".format(prefix, i), 100), ops),
+                        "deposit": _measure(lambda i: john.deposit(10), ops),
+                        "withdraw": _measure(lambda i: john.withdraw(10), ops)})
+        if uses_pool:
+            pool.close()
+    return results
+
+
+def _child(variant: str, directory: str, arguments: tuple, results: multiprocessing.Queue):
+    os.chdir(directory)
+    try:
+        results.put(("ok", _run_variant(variant, *arguments)))
+    except Exception as error:
+        results.put(("error", "{}: {}".format(type(error).__name__, error)))
+
+
+def run(variants=VARIANTS, rows=ROWS, ops: int = 200, journal_modes=JOURNAL_MODES, synchronous=SYNCHRONOUS) -> dict:
+    context = multiprocessing.get_context("spawn")  # a fresh interpreter, so every variant is imported from scratch
+    report = {"started": datetime.datetime.utcnow().isoformat() + "Z", "python": platform.python_version(),
+              "sqlite": sqlite3.sqlite_version, "platform": platform.platform(), "ops": ops,
+              "results": [], "errors": {}}
+    for variant in variants:
+        with tempfile.TemporaryDirectory(prefix="bench-{}-".format(variant)) as directory:
+            results = context.Queue()
+            child = context.Process(target=_child, args=(variant, directory,
+                                                         (list(rows), ops, list(journal_modes), list(synchronous)),
+                                                         results))
+            child.start()
+            status, value = results.get()
+            child.join()
+            if status == "ok":
+                report["results"].extend(value)
+            else:
+                report["errors"][variant] = value
+            print("{}: {}".format(variant, "done" if status == "ok" else value), file=sys.stderr)
+    return report
+
+
+def _key(result: dict) -> tuple:
+    return result["variant"], result["rows"], result["journal_mode"], result["synchronous"], result["operation"]
+
+
+# Prints how each measurement changed from an earlier run. Returns the rows that got slower than "threshold".
+def compare(old: dict, new: dict, threshold: float = 0.10) -> list:
+    before = {_key(result): result for result in old["results"]}
+    slower = []
+    for result in new["results"]:
+        previous = before.get(_key(result))
+        if previous is None or not previous["ops_per_sec"] or not result["ops_per_sec"]:
+            continue
+        change = result["ops_per_sec"] / previous["ops_per_sec"] - 1
+        print("{:<16} {:>9} {:<7} {:<7} {:<13} {:>12.1f} -> {:>12.1f} ops/sec {:+7.1%}".format(
+            result["variant"], result["rows"], str(result["journal_mode"]), str(result["synchronous"]),
+            result["operation"], previous["ops_per_sec"], result["ops_per_sec"], change))
+        if change < -threshold:
+            slower.append(result)
+    return slower
+
+
+def _print_report(report: dict):
+    for result in report["results"]:
+        print("{:<16} {:>9} {:<7} {:<7} {:<13} {:>12.1f} ops/sec  p50 {:8.3f} ms  p99 {:8.3f} ms".format(
+            result["variant"], result["rows"], str(result["journal_mode"]), str(result["synchronous"]),
+            result["operation"], result["ops_per_sec"] or 0, result["p50_ms"], result["p99_ms"]))
+    for variant, error in report["errors"].items():
+        print("{}: failed with {}".format(variant, error))
+
+
+def _list(text: str) -> list:
+    return [item.strip() for item in text.split(",") if item.strip()]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the Account versions")
+    parser.add_argument("--variants", default=",".join(VARIANTS))
+    parser.add_argument("--rows", default=",".join(str(rows) for rows in ROWS))
+    parser.add_argument("--ops", type=int, default=200, help="operations per measurement")
+    parser.add_argument("--journal-modes", default=",".join(JOURNAL_MODES))
+    parser.add_argument("--synchronous", default=",".join(SYNCHRONOUS))
+    parser.add_argument("--output", default="benchmark.json")
+    parser.add_argument("--compare", help="an earlier --output file")
+    options = parser.parse_args()
+
+    report = run(_list(options.variants), [int(rows) for rows in _list(options.rows)], options.ops,
+                 _list(options.journal_modes), _list(options.synchronous))
+    with open(options.output, "w") as output:
+        json.dump(report, output, indent=2)
+    _print_report(report)
+    if options.compare:
+        with open(options.compare) as earlier:
+            slower = compare(json.load(earlier), report)
+        print("{} measurements more than 10% slower".format(len(slower)))
@@ -0,0 +1,137 @@
+
+# =======================================================
+# Connection pool
+# =======================================================
+
+# =============
+# connpool.py
+# =============
+
+# rollback.py to rollback7.py all create ONE sqlite3.connect("accounts.sqlite") when they are imported and share it.
+# A sqlite3 connection can't safely be used by several threads, and every reader has to wait behind the writers.
+
+# ConnectionPool gives us:
+#   - one writer connection. Threads take turns using it with "with pool.writing() as db:"
+#   - one read connection per thread, from pool.reader()
+#   - WAL journal mode, so readers keep reading while a deposit is being committed
+#   - configurable "synchronous" and "cache_size" pragmas, and the size of sqlite3's prepared statement cache
+#   - the writer's Statements (see statements.py), to run the named statements with reused cursors
+#   - a BalanceCache (see balancecache.py) shared by every Account using this pool
+#   - an optional Probe (see instruments.py) that times the Account operations
+#   - an optional event sink (see events.py) for the Account messages, instead of printing them
+
+# The connections are only opened the first time they are needed.
+
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from balancecache import BalanceCache
+from statements import Statements
+
+_JOURNAL_MODES = {"DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF"}
+_SYNCHRONOUS = {"OFF", "NORMAL", "FULL", "EXTRA"}
+
+
+class ConnectionPool(object):
+
+    # on_create is called with the writer connection when it is opened (rollback7.py uses it to create the tables)
+    # Whatever it returns is kept in pool.schema
+    def __init__(self, database: str = "accounts.sqlite", journal_mode: str = "WAL", synchronous: str = "NORMAL",
+                 cache_size: int = -2000, detect_types: int = 0, on_create=None, balance_cache_size: int = 10000,
+                 probe=None, events=None, cached_statements: int = 128):
+        journal_mode = journal_mode.upper()
+        synchronous = synchronous.upper()
+        if journal_mode not in _JOURNAL_MODES:
+            raise ValueError("Unknown journal_mode {!r}".format(journal_mode))
+        if synchronous not in _SYNCHRONOUS:
+            raise ValueError("Unknown synchronous setting {!r}".format(synchronous))
+
+        self.database = database
+        self.journal_mode = journal_mode
+        self.synchronous = synchronous
+        self.cache_size = int(cache_size)  # negative values are KiB, positive values are pages
+        self.detect_types = detect_types
+        self.cached_statements = int(cached_statements)  # prepared statements kept by each connection
+        self.on_create = on_create
+        self.balances = BalanceCache(balance_cache_size)
+        self.probe = probe  # an instruments.Probe to time the Account operations, or None
+        self.events = events  # where Account sends its messages (see events.py), None means print them
+
+        self._writer = None
+        self._statements = None
+        self._schema = None
+        self._write_lock = threading.RLock()
+        self._local = threading.local()
+        self._readers = []
+        self._readers_lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.database, detect_types=self.detect_types, check_same_thread=False,
+                                     cached_statements=self.cached_statements)
+        connection.execute("PRAGMA journal_mode = {}".format(self.journal_mode))
+        connection.execute("PRAGMA synchronous = {}".format(self.synchronous))
+        connection.execute("PRAGMA cache_size = {}".format(self.cache_size))
+        return connection
+
+    # Once the writer is open this doesn't take the write lock, so reading pool.schema or pool.statements
+    # doesn't wait for the thread that is writing. _writer is set last, after _statements and _schema.
+    @property
+    def writer(self) -> sqlite3.Connection:
+        writer = self._writer
+        if writer is not None:
+            return writer
+        with self._write_lock:
+            if self._writer is None:
+                writer = self._connect()
+                self._statements = Statements(writer)
+                if self.on_create is not None:
+                    self._schema = self.on_create(writer)
+                    writer.commit()
+                self._writer = writer
+            return self._writer
+
+    @property
+    def schema(self):
+        if self._writer is None:
+            self.writer  # on_create runs when the writer is opened
+        return self._schema
+
+    # The named statements on the writer connection, only use them inside "with pool.writing() as db:"
+    @property
+    def statements(self) -> Statements:
+        if self._writer is None:
+            self.writer
+        return self._statements
+
+    # Only one thread at a time can be inside "with pool.writing() as db:"
+    @contextmanager
+    def writing(self):
+        with self._write_lock:
+            yield self.writer
+
+    # Each thread gets its own read connection
+    def reader(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            self.writer  # make sure the tables exist before anyone reads them
+            connection = self._connect()
+            connection.execute("PRAGMA query_only = ON")
+            self._local.connection = connection
+            with self._readers_lock:
+                self._readers.append(connection)
+        return connection
+
+    def close(self):
+        with self._readers_lock:
+            for connection in self._readers:
+                connection.close()
+            self._readers = []
+        self._local = threading.local()
+        with self._write_lock:
+            if self._writer is not None:
+                writer, self._writer = self._writer, None
+                self._statements.close()
+                self._statements = None
+                writer.close()
+            self.balances.clear()
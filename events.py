@@ -0,0 +1,122 @@
+
+# =======================================================
+# Account events instead of print()
+# =======================================================
+
+# ===========
+# events.py
+# ===========
+
+# rollback7.Account prints a line for every deposit, withdrawal and new account.
+# At tens of thousands of operations per second, formatting and writing those lines costs more than SQLite.
+
+# Instead Account sends each one as an event to its pool's "sink":
+#   sink.emit(kind, account name, amount, balance)      amounts and balances in cents
+# The kinds are:
+#   created, retrieved   Account(name) made a new account / found it in the database (amount is None)
+#   deposited            amount was deposited
+#   withdrawn            amount was withdrawn
+#   refused              a withdrawal (amount) was refused
+#   balance              show_balance() was called
+#   loaded               Account.load_many (account is None, amount is how many were found, balance how many created)
+
+# The sinks:
+#   ConsoleSink     prints the same lines as before. It is what a pool uses when pool.events is None,
+#                   so nothing changes unless you choose another sink
+#   NullSink        does nothing (quiet mode)
+#   RingBufferSink  keeps the last "size" events in memory, for tests or a debug page
+#   AsyncLogSink    puts events on a queue, and a background thread writes them as JSON lines,
+#                   so the Account methods never wait for the disk or the terminal
+
+#   pool = ConnectionPool("accounts.sqlite", on_create=create_schema, events=NullSink())
+
+import collections
+import json
+import queue
+import sys
+import threading
+import time
+
+
+class NullSink(object):
+
+    def emit(self, kind: str, account: str, amount: int = None, balance: int = None):
+        pass
+
+
+class ConsoleSink(object):
+
+    def __init__(self, stream=None):
+        self.stream = stream  # None means whatever sys.stdout is when the event happens
+
+    def emit(self, kind: str, account: str, amount: int = None, balance: int = None):
+        stream = self.stream if self.stream is not None else sys.stdout
+        if kind == "created" or kind == "retrieved":
+            stream.write("{} for {}. Balance on account {} is {:.2f}\n".format(
+                "Account created" if kind == "created" else "Retrieved record", account, account, balance / 100))
+        elif kind == "deposited":
+            stream.write("{:.2f} deposited\n".format(amount / 100))
+        elif kind == "withdrawn":
+            stream.write("{:.2f} withdrawn\n".format(amount / 100))
+        elif kind == "refused":
+            stream.write("The amount must be greater than zero and no more than your account balance\n")
+        elif kind == "balance":
+            stream.write("Balance on account {} is {:.2f}\n".format(account, balance / 100))
+        elif kind == "loaded":
+            stream.write("Retrieved {} accounts, created {} accounts\n".format(amount, balance))
+
+
+class RingBufferSink(object):
+
+    def __init__(self, size: int = 10000):
+        self.events = collections.deque(maxlen=size)  # (time, kind, account, amount, balance)
+
+    def emit(self, kind: str, account: str, amount: int = None, balance: int = None):
+        self.events.append((time.time(), kind, account, amount, balance))  # deque.append is thread safe
+
+    def clear(self):
+        self.events.clear()
+
+
+class AsyncLogSink(object):
+
+    _STOP = object()
+
+    # path is a file name (opened in append mode) or an open text stream
+    def __init__(self, path="accounts-events.log"):
+        self._own_file = isinstance(path, str)
+        self._stream = open(path, "a", encoding="utf-8") if self._own_file else path
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._write, name="event-log", daemon=True)
+        self._thread.start()
+
+    def emit(self, kind: str, account: str, amount: int = None, balance: int = None):
+        self._queue.put((time.time(), kind, account, amount, balance))
+
+    def _write(self):
+        while True:
+            events = [self._queue.get()]
+            while True:  # write everything that is waiting at once
+                try:
+                    events.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            stopping = AsyncLogSink._STOP in events
+            self._stream.write("".join(
+                json.dumps({"time": when, "kind": kind, "account": account, "amount": amount, "balance": balance})
+                + "\n" for when, kind, account, amount, balance in
+                (event for event in events if event is not AsyncLogSink._STOP)))
+            self._stream.flush()
+            if stopping:
+                return
+
+    # Writes the events still waiting, then stops the thread
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(AsyncLogSink._STOP)
+            self._thread.join()
+        if self._own_file:
+            self._stream.close()
+
+
+console = ConsoleSink()
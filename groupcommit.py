@@ -0,0 +1,126 @@
+
+# =======================================================
+# Group commit with a writer thread
+# =======================================================
+
+# ================
+# groupcommit.py
+# ================
+
+# In rollback7.py deposit() and withdraw() wait for their own commit (and fsync) before they return.
+# With group commit, many threads hand their operations to ONE writer thread.
+# The writer thread saves everything that is waiting in a single transaction (using batchledger.apply_batch)
+# when either max_ops operations have been collected or max_delay_ms milliseconds have passed.
+
+# deposit() and withdraw() return a Future straight away.
+# future.result() is True once the change has been committed, or False if it was rolled back or refused.
+# max_delay_ms puts an upper limit on how long an operation waits before its commit starts.
+
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from batchledger import apply_batch
+from connpool import ConnectionPool
+from rollback7 import Account, default_pool
+
+
+class GroupCommitWriter(object):
+
+    _STOP = object()  # put on the queue to stop the writer thread
+
+    def __init__(self, pool: ConnectionPool = None, max_ops: int = 500, max_delay_ms: float = 5.0):
+        self._pool = pool if pool is not None else default_pool
+        self.max_ops = max_ops
+        self.max_delay = max_delay_ms / 1000
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="group-commit-writer", daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def submit(self, account: Account, amount: int) -> Future:
+        future = Future()
+        op_time = Account._current_time(account.name, self._pool.schema["time_format"])
+        self._queue.put((account, amount, op_time, future))
+        return future
+
+    def deposit(self, account: Account, amount: int) -> Future:
+        if amount > 0:
+            return self.submit(account, amount)
+        return _done(False)
+
+    # The overdraft check is done again by the writer thread, because other threads
+    # may have withdrawals for the same account waiting in the queue.
+    def withdraw(self, account: Account, amount: int) -> Future:
+        if 0 < amount <= account._balance:
+            return self.submit(account, -amount)
+        return _done(False)
+
+    # Waits for everything already queued to be committed, then stops the writer thread
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(GroupCommitWriter._STOP)
+            self._thread.join()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch = [self._queue.get()]  # wait for the first operation
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_ops:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            if GroupCommitWriter._STOP in batch:
+                stopping = True
+                batch.remove(GroupCommitWriter._STOP)
+                while True:  # commit whatever is still waiting
+                    try:
+                        batch.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+            self._commit(batch)
+
+    def _commit(self, batch: list):
+        if not batch:
+            return
+        try:
+            results = apply_batch(self._pool, [(account, amount, op_time) for account, amount, op_time, _ in batch])
+        except Exception as error:
+            for *_, future in batch:
+                future.set_exception(error)
+        else:
+            for (*_, future), result in zip(batch, results):
+                future.set_result(result)
+
+
+def _done(result) -> Future:
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+if __name__ == '__main__':
+    john = Account("John")
+    eric = Account("Eric", 7000)
+
+    with GroupCommitWriter(max_ops=100, max_delay_ms=2) as writer:
+        futures = [writer.deposit(john, 10) for _ in range(50)]
+        futures.append(writer.withdraw(eric, 500))
+        print("{} of {} operations committed".format(sum(f.result() for f in futures), len(futures)))
+
+    john.show_balance()
+    eric.show_balance()
+
+    default_pool.close()
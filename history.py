@@ -0,0 +1,133 @@
+
+# =======================================================
+# Reading the history table
+# =======================================================
+
+# ============
+# history.py
+# ============
+
+# checkdb.py reads history with detect_types=sqlite3.PARSE_DECLTYPES, so sqlite3 turns every time
+# back into a datetime, even when we never look at it.
+
+# HistoryRow keeps the raw value from the database and only makes a datetime when you ask for row.time.
+# It works for both formats of history.time (see rollback7.create_schema):
+#   TIMESTAMP - ISO text, parsed with monoclock.parse_timestamp
+#   EPOCH_US  - integer microseconds since 1970, converted with monoclock.from_us
+# row.time_us gives you the time as an integer for both formats (free for EPOCH_US).
+# row.zone is the tzinfo from the zones table (see zones.py), and row.local_time is the original local time.
+
+import datetime
+import sqlite3
+
+from monoclock import from_us, parse_timestamp, storage_time, to_us
+from rollback7 import history_time_format
+from zones import ZoneTable
+
+
+class HistoryRow(object):
+
+    __slots__ = ("raw_time", "account", "amount", "zone")
+
+    def __init__(self, raw_time, account: str, amount: int, zone: datetime.tzinfo = None):
+        self.raw_time = raw_time
+        self.account = account
+        self.amount = amount
+        self.zone = zone
+
+    @property
+    def time(self) -> datetime.datetime:
+        if isinstance(self.raw_time, int):
+            return from_us(self.raw_time)
+        if isinstance(self.raw_time, datetime.datetime):  # read with detect_types after all
+            return self.raw_time
+        return parse_timestamp(self.raw_time)
+
+    @property
+    def time_us(self) -> int:
+        if isinstance(self.raw_time, int):
+            return self.raw_time
+        return to_us(self.time)
+
+    @property
+    def local_time(self) -> datetime.datetime:
+        if self.zone is None:
+            return self.time
+        return self.time.astimezone(self.zone)
+
+    # (time, account) as stored in the database. Pass it as stream_history(after=...) to carry on after this row.
+    @property
+    def key(self) -> tuple:
+        return self.raw_time, self.account
+
+    def __iter__(self):
+        return iter((self.time, self.account, self.amount))
+
+    def __repr__(self):
+        return "HistoryRow({!r}, {!r}, {!r})".format(self.raw_time, self.account, self.amount)
+
+
+# stream_history reads the history table in batches of batch_size rows and yields each batch as a list of HistoryRow.
+# Each batch is a separate query that starts after the last (time, account) of the previous batch
+# (a "keyset" cursor), so memory use is the same for 1,000 rows or 100 million rows,
+# and a reader that stopped can carry on later with after=last_row.key
+
+#   account     - only this account's rows
+#   start, end  - only rows with start <= time < end (aware datetimes, or microseconds since 1970)
+
+# Use a connection WITHOUT detect_types, otherwise sqlite3 parses the times before we get them
+def stream_history(db: sqlite3.Connection, account: str = None, start=None, end=None, after: tuple = None,
+                   batch_size: int = 1000, zones: ZoneTable = None):
+    zones = zones if zones is not None else ZoneTable()
+    time_format = history_time_format(db)
+    conditions = []
+    parameters = []
+    if account is not None:
+        conditions.append("(account = ?)")
+        parameters.append(account)
+    if start is not None:
+        conditions.append("(time >= ?)")
+        parameters.append(storage_time(start, time_format))
+    if end is not None:
+        conditions.append("(time < ?)")
+        parameters.append(storage_time(end, time_format))
+    if account is None:
+        keyset = "((time, account) > (?, ?))"
+        order = "time, account"
+    else:
+        keyset = "(time > ?)"  # there is only one account, so time alone is unique
+        order = "time"
+    sql = "SELECT time, account, amount, zone FROM history WHERE {} ORDER BY {} LIMIT ?"
+
+    while True:
+        where = list(conditions)
+        arguments = list(parameters)
+        if after is not None:
+            where.append(keyset)
+            arguments.extend(after if account is None else after[:1])
+        cursor = db.execute(sql.format(" AND ".join(where) or "1", order), arguments + [batch_size])
+        batch = [HistoryRow(raw_time, name, amount, zones.resolve(db, zone))
+                 for raw_time, name, amount, zone in cursor.fetchmany(batch_size)]
+        if not batch:
+            return
+        yield batch
+        if len(batch) < batch_size:
+            return
+        after = batch[-1].key
+
+
+# One row at a time, still reading in batches underneath
+def history_rows(db: sqlite3.Connection, zones: ZoneTable = None, **filters):
+    for batch in stream_history(db, zones=zones, **filters):
+        yield from batch
+
+
+if __name__ == '__main__':
+    db = sqlite3.connect("accounts.sqlite")
+    rows = 0
+    total = 0
+    for batch in stream_history(db, batch_size=5000):
+        rows += len(batch)
+        total += sum(row.amount for row in batch)
+    print("{} history rows, total amount {:.2f}".format(rows, total / 100))
+    db.close()
@@ -0,0 +1,135 @@
+
+# =======================================================
+# Timing the Account operations
+# =======================================================
+
+# ================
+# instruments.py
+# ================
+
+# Where does the time go in rollback7.Account._save_update? Waiting for the write lock, the UPDATE,
+# the INSERT, or the commit (which is where the fsync happens)?
+
+# A Probe collects, for each named phase, how many times it ran and a histogram of how long it took,
+# plus simple counters (for example how many IntegrityError rollbacks we had).
+# It is switched on for one ConnectionPool:
+#   probe = Probe()
+#   pool.probe = probe          # ConnectionPool(..., probe=probe) does the same
+#   ... run deposits and withdrawals ...
+#   print(probe.report())
+#   json.dump(probe.export(), file)
+#   pool.probe = None           # off again
+
+# When pool.probe is None, the Account methods only do an "is not None" test, nothing is timed or counted.
+
+# The phases timed by rollback7.py:
+#   account.init            Account(name, balance), all of it
+#   account.deposit         deposit(), all of it (including the print)
+#   account.withdraw        withdraw(), all of it
+#   save_update             _save_update(), all of it
+#   save_update.lock        waiting for the pool's writer and BEGIN IMMEDIATE (the file's write lock)
+#   save_update.update      the UPDATE accounts statement
+#   save_update.insert      the INSERT INTO history statement (plus the snapshot and key, if any)
+#   save_update.commit      db.commit(), so mostly the fsync
+#   save_update.rollback    db.rollback() after an error
+# and counters save_update.integrity_error, save_update.error, save_update.refused, save_update.duplicate.
+# save_update minus its lock/update/insert/commit phases is the time spent in Python.
+
+# Hooks are called with (phase, seconds) for every timing, to send them somewhere else (a log, statsd, ...)
+
+import threading
+import time
+
+# histogram bucket upper bounds in microseconds: 1, 2, 4, ... about 67 seconds, then everything above
+_BUCKETS = [1 << power for power in range(27)]
+
+
+class Histogram(object):
+
+    def __init__(self):
+        self.counts = [0] * (len(_BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0    # seconds
+        self.maximum = 0.0  # seconds
+
+    def add(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.maximum:
+            self.maximum = seconds
+        # the bucket is the number of bits in the time in microseconds, so no search is needed
+        self.counts[min(int(seconds * 1000000).bit_length(), len(_BUCKETS))] += 1
+
+    # The smallest bucket bound (in seconds) with at least "fraction" of the timings at or below it
+    def quantile(self, fraction: float) -> float:
+        needed = fraction * self.count
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= needed:
+                return _BUCKETS[bucket] / 1000000 if bucket < len(_BUCKETS) else self.maximum
+        return 0.0
+
+    def export(self) -> dict:
+        return {"count": self.count, "total_seconds": self.total, "max_seconds": self.maximum,
+                "p50_seconds": self.quantile(0.50), "p99_seconds": self.quantile(0.99),
+                "buckets": [{"le_us": _BUCKETS[bucket] if bucket < len(_BUCKETS) else None, "count": count}
+                            for bucket, count in enumerate(self.counts) if count]}
+
+
+class Probe(object):
+
+    clock = staticmethod(time.perf_counter)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.histograms = {}  # phase -> Histogram
+        self.counters = {}    # name -> int
+        self.hooks = []       # callables (phase, seconds)
+
+    # Saves the time since "started" (a value from probe.clock()) and returns the time now,
+    # so phases can be chained:  mark = probe.lap("phase 1", mark); mark = probe.lap("phase 2", mark)
+    def lap(self, phase: str, started: float) -> float:
+        now = time.perf_counter()
+        self.record(phase, now - started)
+        return now
+
+    def record(self, phase: str, seconds: float):
+        with self._lock:
+            histogram = self.histograms.get(phase)
+            if histogram is None:
+                histogram = self.histograms[phase] = Histogram()
+            histogram.add(seconds)
+        for hook in self.hooks:
+            hook(phase, seconds)
+
+    def count(self, name: str, increment: int = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + increment
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def reset(self):
+        with self._lock:
+            self.histograms = {}
+            self.counters = {}
+
+    def export(self) -> dict:
+        with self._lock:
+            return {"phases": {phase: histogram.export() for phase, histogram in self.histograms.items()},
+                    "counters": dict(self.counters)}
+
+    def report(self) -> str:
+        lines = []
+        with self._lock:
+            for phase in sorted(self.histograms):
+                histogram = self.histograms[phase]
+                lines.append("{:<22} {:>8} calls  {:>10.3f} ms total  {:>8.3f} ms avg  p50 <= {:.3f} ms"
+                             "  p99 <= {:.3f} ms".format(phase, histogram.count, histogram.total * 1000,
+                                                         histogram.total / histogram.count * 1000,
+                                                         histogram.quantile(0.50) * 1000,
+                                                         histogram.quantile(0.99) * 1000))
+            for name in sorted(self.counters):
+                lines.append("{:<22} {:>8}".format(name, self.counters[name]))
+        return "\n".join(lines)
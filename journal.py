@@ -0,0 +1,302 @@
+
+# =======================================================
+# Write-ahead operation journal
+# =======================================================
+
+# ============
+# journal.py
+# ============
+
+# In rollback7._save_update, if the program dies after the UPDATE but before db.commit(),
+# the deposit is lost, and deposit() may already have printed "deposited".
+
+# OpJournal writes every operation to an append-only file BEFORE it goes near the database:
+#   1. the operation gets a key (a uuid unless we are given one) and a time
+#   2. it is appended to the journal file as one line of JSON. One writer thread writes whatever is
+#      waiting and then does ONE os.fsync for all of it (like the group commit in groupcommit.py)
+#   3. once the fsync has returned, the operation is safe on disk and submit()'s Future is done
+#   4. an applier thread saves the journaled operations to SQLite in large batches with
+#      batchledger.apply_batch, which saves each key in operation_keys in the same transaction
+# When everything in the journal has been applied, the file is emptied.
+
+# If a batch's transaction fails (the file is locked, the disk is full, ...) its operations are NOT lost:
+# they stay in the journal and are tried again with the next batch (flush() also tries them again).
+# When everything else has been applied, the journal is rewritten with only those operations in it.
+# flush() and outcome() raise NotApplied for operations whose last try failed.
+
+# If we crash, OpJournal(...) reads the journal when it starts and applies it again.
+# Operations that were already committed have their key in operation_keys and are skipped,
+# so nothing is applied twice. A torn last line (we died while writing it) was never acknowledged and is ignored.
+# Keys are only kept for keys.ttl seconds (see operationkeys.py), so for an operation older than that we can't
+# tell if it was applied: it is NOT applied again but moved to "<path>.stale" for someone to look at.
+
+#   with OpJournal("accounts.journal") as journal:
+#       journal.deposit(john, 1000).result()      # returns as soon as the journal has been fsync'ed
+#       key = journal.withdraw(john, 50).result()
+#       journal.flush()                           # waits until everything has been applied to the database
+#       journal.outcome(key)                      # True (applied), False (refused) or None (not applied yet)
+
+import json
+import os
+import queue
+import threading
+import time
+import uuid
+from concurrent.futures import Future, wait
+
+from batchledger import apply_batch
+from connpool import ConnectionPool
+from monoclock import parse_timestamp, to_us
+from operationkeys import now_us
+from rollback7 import Account, default_pool
+
+
+# The operations (their keys) that are safe in the journal but couldn't be applied to the database yet
+class NotApplied(Exception):
+
+    def __init__(self, keys: list):
+        super().__init__("{} journaled operations could not be applied yet".format(len(keys)))
+        self.keys = keys
+
+
+class OpJournal(object):
+
+    _STOP = object()  # put on the queues to stop the threads
+
+    def __init__(self, path: str = "accounts.journal", pool: ConnectionPool = None, max_ops: int = 500,
+                 max_delay_ms: float = 5.0, max_batch: int = 10000):
+        self.path = path
+        self._pool = pool if pool is not None else default_pool
+        self.max_ops = max_ops              # operations per fsync
+        self.max_delay = max_delay_ms / 1000
+        self.max_batch = max_batch          # operations per database transaction
+        self.stale = 0         # operations too old to replay safely, moved to path + ".stale"
+        self._failed = {}      # key -> (account, amount, time, key) of operations whose last try failed
+        self.replayed = self._replay()
+        self._file = open(path, "a", encoding="utf-8")
+        self._written = 0
+        self._applied = 0
+        self._state = threading.Condition()
+        self._incoming = queue.Queue()
+        self._journaled = queue.Queue()
+        self._writer = threading.Thread(target=self._write, name="journal-writer", daemon=True)
+        self._applier = threading.Thread(target=self._apply, name="journal-applier", daemon=True)
+        self._writer.start()
+        self._applier.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    # The Future's result is the operation's key, once the operation is safely in the journal
+    def submit(self, account: Account, amount: int, key: str = None) -> Future:
+        future = Future()
+        key = key if key is not None else uuid.uuid4().hex
+        op_time = Account._current_time(account.name, self._pool.schema["time_format"])
+        self._incoming.put((account, amount, op_time, key, future))
+        return future
+
+    def deposit(self, account: Account, amount: int, key: str = None) -> Future:
+        if amount <= 0:
+            raise ValueError("The amount must be greater than zero")
+        return self.submit(account, amount, key)
+
+    # The overdraft check is done when the operation is applied. If it is refused, outcome(key) is False.
+    def withdraw(self, account: Account, amount: int, key: str = None) -> Future:
+        if amount <= 0:
+            raise ValueError("The amount must be greater than zero")
+        return self.submit(account, -amount, key)
+
+    # True if the operation was applied, False if it was refused, None if it hasn't been applied yet.
+    # Raises NotApplied if it was tried and its transaction failed (it will be tried again).
+    def outcome(self, key: str):
+        row = self._pool.reader().execute("SELECT applied FROM operation_keys WHERE (key = ?)", (key,)).fetchone()
+        if row is None and key in self._failed:
+            raise NotApplied([key])
+        return None if row is None else bool(row[0])
+
+    # Waits until everything journaled so far has been applied to the database, trying the failed operations
+    # once more. Raises NotApplied with the keys of the operations that still couldn't be applied.
+    def flush(self):
+        done = Future()
+        self._journaled.put(done)  # the applier sets it after the batches that were journaled before it
+        while not done.done() and self._applier.is_alive():
+            wait([done], timeout=0.1)
+        failed = list(self._failed)
+        if failed:
+            raise NotApplied(failed)
+
+    def close(self):
+        if self._writer.is_alive():
+            self._incoming.put(OpJournal._STOP)
+            self._writer.join()
+        self._applier.join()
+        self._file.close()
+
+    # Applies whatever is in the journal file (after a crash), then empties it, keeping only the operations
+    # that failed (they are tried again by the applier). Returns how many were replayed.
+    def _replay(self) -> int:
+        try:
+            with open(self.path, encoding="utf-8") as journal:
+                entries = []
+                for line in journal:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        break  # torn write at the end of the file
+        except FileNotFoundError:
+            return 0
+        if not entries:
+            return 0
+        oldest = now_us() - int(self._pool.schema["keys"].ttl * 1000000)
+        stale = [entry for entry in entries if _entry_us(entry["time"]) < oldest]
+        if stale:
+            recorded = self._recorded([entry["key"] for entry in stale])
+            stale = [entry for entry in stale if entry["key"] not in recorded]
+            with open(self.path + ".stale", "a", encoding="utf-8") as stale_file:
+                stale_file.write("".join(json.dumps(entry) + "\n" for entry in stale))
+                stale_file.flush()
+                os.fsync(stale_file.fileno())
+            self.stale = len(stale)
+            entries = [entry for entry in entries if _entry_us(entry["time"]) >= oldest]
+
+        accounts = {account.name: account
+                    for account in Account.load_many([(entry["account"], 0) for entry in entries], self._pool)}
+        for start in range(0, len(entries), self.max_batch):
+            chunk = entries[start:start + self.max_batch]
+            self._apply_batch([(accounts[entry["account"]], entry["amount"], entry["time"], entry["key"])
+                               for entry in chunk])
+        with open(self.path, "w", encoding="utf-8") as journal:
+            self._rewrite(journal)
+        return len(entries)
+
+    # Applies (account, amount, time, key) operations. The ones whose transaction failed go in _failed.
+    def _apply_batch(self, batch: list):
+        keys = [key for _, _, _, key in batch]
+        results = apply_batch(self._pool, [(account, amount, op_time) for account, amount, op_time, _ in batch], keys)
+        # False can also mean the transaction was rolled back by an error (not just a refused withdrawal)
+        recorded = set(keys) if all(results) else self._recorded(keys)
+        for operation in batch:
+            if operation[3] in recorded:
+                self._failed.pop(operation[3], None)
+            else:
+                self._failed[operation[3]] = operation
+
+    # Empties the journal file, except for the operations that failed
+    def _rewrite(self, journal):
+        journal.truncate(0)
+        if self._failed:
+            journal.write("".join(_entry(*operation) + "\n" for operation in self._failed.values()))
+        journal.flush()
+        os.fsync(journal.fileno())
+
+    # Writer thread: append, fsync once per group, acknowledge, pass on to the applier
+    def _write(self):
+        stopping = False
+        while not stopping:
+            batch = [self._incoming.get()]
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_ops:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._incoming.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            if OpJournal._STOP in batch:
+                stopping = True
+                batch.remove(OpJournal._STOP)
+                while True:
+                    try:
+                        batch.append(self._incoming.get_nowait())
+                    except queue.Empty:
+                        break
+            if batch:
+                try:
+                    with self._state:
+                        self._file.write("".join(_entry(account, amount, op_time, key) + "\n"
+                                                 for account, amount, op_time, key, _ in batch))
+                        self._file.flush()
+                        os.fsync(self._file.fileno())
+                        self._written += len(batch)
+                except Exception as error:
+                    for *_, future in batch:
+                        future.set_exception(error)
+                else:
+                    for account, amount, op_time, key, future in batch:
+                        future.set_result(key)
+                    self._journaled.put(batch)
+        self._journaled.put(OpJournal._STOP)
+
+    # Applier thread: saves journaled operations to the database in large batches.
+    # The operations that failed before are tried again first. Futures on the queue come from flush().
+    def _apply(self):
+        stopping = False
+        while not stopping:
+            waiting = [self._journaled.get()]
+            while True:
+                try:
+                    waiting.append(self._journaled.get_nowait())
+                except queue.Empty:
+                    break
+                if sum(len(item) for item in waiting if isinstance(item, list)) >= self.max_batch:
+                    break
+            stopping = OpJournal._STOP in waiting
+            new = [operation[:4] for item in waiting if isinstance(item, list) for operation in item]
+            batch = list(self._failed.values()) + new
+            for start in range(0, len(batch), self.max_batch):
+                self._apply_batch(batch[start:start + self.max_batch])
+            with self._state:
+                self._applied += len(new)
+                if self._applied == self._written:
+                    self._rewrite(self._file)  # only the failed operations are still needed
+            for item in waiting:
+                if isinstance(item, Future):
+                    item.set_result(None)
+        while True:  # a flush() that came after close()
+            try:
+                item = self._journaled.get_nowait()
+            except queue.Empty:
+                break
+            if isinstance(item, Future):
+                item.set_result(None)
+
+    # The keys (of these) that are in operation_keys
+    def _recorded(self, keys: list) -> set:
+        db = self._pool.reader()
+        found = set()
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            found.update(key for key, in db.execute("SELECT key FROM operation_keys WHERE key IN ({})".format(
+                ", ".join("?" * len(chunk))), chunk))
+        return found
+
+
+# One line of the journal. datetimes are saved as the ISO string sqlite3 would have stored, integer times as they are
+def _entry(account: Account, amount: int, op_time, key: str) -> str:
+    return json.dumps({"key": key, "account": account.name, "amount": amount,
+                       "time": op_time if isinstance(op_time, int) else str(op_time)})
+
+
+def _entry_us(op_time) -> int:
+    return op_time if isinstance(op_time, int) else to_us(parse_timestamp(op_time))
+
+
+if __name__ == '__main__':
+    john = Account("John")
+
+    with OpJournal() as journal:
+        keys = [journal.deposit(john, 10) for _ in range(50)]
+        keys = [future.result() for future in keys]
+        print("{} deposits journaled".format(len(keys)))
+        journal.flush()
+        print("{} deposits applied".format(sum(journal.outcome(key) for key in keys)))
+        journal.deposit(john, 10, key=keys[0]).result()  # the same key again
+        journal.flush()
+
+    john.show_balance()
+
+    default_pool.close()
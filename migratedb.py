@@ -0,0 +1,144 @@
+
+# =======================================================
+# Migrating an existing accounts.sqlite file
+# =======================================================
+
+# ==============
+# migratedb.py
+# ==============
+
+# migrate_to_epoch converts the history.time column of an existing database from TIMESTAMP (ISO text) to EPOCH_US
+# (integer microseconds since 1970). See rollback7.create_schema for the two formats.
+
+# migrate_zones converts a file from the rollback6.py timezone challenge, where history.zone holds
+# pickle.dumps(zone) in every row, to the interned "zones" table (see zones.py).
+
+#   python migratedb.py accounts.sqlite
+
+# The history table (and the snapshots table, if there is one) is copied into a new table in chunks
+# (so memory use stays small), then the old table is dropped and the new one renamed, all in ONE transaction.
+# If anything goes wrong the transaction is rolled back and the file is left as it was.
+# Any other columns (for example the "zone" column from rollback6.py) are copied unchanged.
+
+import pickle
+import sqlite3
+import sys
+
+from monoclock import parse_timestamp, to_us
+from rollback7 import EPOCH_US, history_time_format
+from zones import ZoneTable, zone_key
+
+CHUNK = 10000
+
+
+def _to_epoch_us(value) -> int:
+    if isinstance(value, int):
+        return value  # already an integer (for example CHANGE_1's "return 1")
+    return to_us(parse_timestamp(value))
+
+
+def migrate_to_epoch(database: str) -> int:
+    db = sqlite3.connect(database)  # no detect_types, we want the raw text
+    try:
+        if history_time_format(db) == EPOCH_US:
+            print("{}: history.time is already stored as integer microseconds".format(database))
+            return 0
+
+        tables = [row[0] for row in db.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+        views = db.execute("SELECT name, sql FROM sqlite_master WHERE type = 'view'").fetchall()
+
+        copied = 0
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            for name, _ in views:  # views that use history.time must be recreated for integer times
+                db.execute("DROP VIEW {}".format(name))
+            db.execute("PRAGMA user_version = 0")  # so rollback7.create_schema creates the indexes again
+            copied = _convert_times(db, "history", "time, account")
+            if "snapshots" in tables:  # balance checkpoints use the same time format (see snapshots.py)
+                _convert_times(db, "snapshots", "account, time")
+            for name, sql in views:
+                if name == "localhistory":
+                    db.execute("CREATE VIEW localhistory AS"
+                               " SELECT strftime('%Y-%m-%d %H:%M:%f', history.time / 1000000.0, 'unixepoch',"
+                               " 'localtime') AS localtime, history.account, history.amount"
+                               " FROM history ORDER BY history.time")
+                else:
+                    print("View {} was dropped, recreate it for integer times: {}".format(name, sql))
+        except (sqlite3.Error, ValueError):
+            db.rollback()
+            raise
+        else:
+            db.commit()
+        print("{}: converted {} history rows to integer microseconds".format(database, copied))
+        return copied
+    finally:
+        db.close()
+
+
+# Copies "table" into a new table with an INTEGER time column, then swaps the new table in.
+# Indexes are not copied: rollback7.create_schema creates them again the next time the file is opened.
+def _convert_times(db: sqlite3.Connection, table: str, primary_key: str) -> int:
+    columns = [(column[1], column[2], column[3]) for column in db.execute("PRAGMA table_info({})".format(table))]
+    time_index = [name for name, _, _ in columns].index("time")
+    definitions = ", ".join("{} {}{}".format(name, EPOCH_US if name == "time" else declared_type,
+                                            " NOT NULL" if not_null else "")
+                            for name, declared_type, not_null in columns)
+    column_names = ", ".join(name for name, _, _ in columns)
+    placeholders = ", ".join("?" * len(columns))
+
+    db.execute("CREATE TABLE {}_new ({}, PRIMARY KEY ({}))".format(table, definitions, primary_key))
+    copied = 0
+    cursor = db.execute("SELECT {} FROM {}".format(column_names, table))
+    rows = cursor.fetchmany(CHUNK)
+    while rows:
+        converted = []
+        for row in rows:
+            row = list(row)
+            row[time_index] = _to_epoch_us(row[time_index])
+            converted.append(row)
+        db.executemany("INSERT INTO {}_new VALUES({})".format(table, placeholders), converted)
+        copied += len(converted)
+        rows = cursor.fetchmany(CHUNK)
+
+    db.execute("DROP TABLE {}".format(table))
+    db.execute("ALTER TABLE {0}_new RENAME TO {0}".format(table))
+    return copied
+
+
+# Each different pickled zone is unpickled ONCE, added to the zones table,
+# and then all the rows using it are updated with a single UPDATE.
+def migrate_zones(database: str) -> int:
+    db = sqlite3.connect(database)
+    try:
+        columns = [column[1] for column in db.execute("PRAGMA table_info(history)")]
+        if "zone" not in columns:
+            print("{}: history has no zone column, nothing to convert".format(database))
+            return 0
+
+        db.execute("CREATE TABLE IF NOT EXISTS zones (id INTEGER PRIMARY KEY, utcoffset INTEGER NOT NULL,"
+                   " name TEXT NOT NULL, UNIQUE (utcoffset, name))")
+        db.commit()
+        zones = ZoneTable()
+        blobs = [row[0] for row in db.execute("SELECT DISTINCT zone FROM history WHERE typeof(zone) = 'blob'")]
+        ids = {blob: zones.intern(db, zone_key(pickle.loads(blob))) for blob in blobs}
+
+        converted = 0
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            for blob, zone_id in ids.items():
+                converted += db.execute("UPDATE history SET zone = ? WHERE (zone = ?)", (zone_id, blob)).rowcount
+        except sqlite3.Error:
+            db.rollback()
+            raise
+        else:
+            db.commit()
+        print("{}: {} pickled zones interned, {} history rows converted".format(database, len(ids), converted))
+        return converted
+    finally:
+        db.close()
+
+
+if __name__ == '__main__':
+    for path in sys.argv[1:] or ["accounts.sqlite"]:
+        migrate_zones(path)
+        migrate_to_epoch(path)
@@ -0,0 +1,293 @@
+
+# =======================================================
+# Money as whole cents, without Decimal
+# =======================================================
+
+# ==========
+# money.py
+# ==========
+
+# rollback4_Ref.py and rollbackTrainer2.py do Decimal(amount).quantize(Account._qb) on every deposit and withdrawal.
+# That makes a new Decimal (two, with quantize) each time, and it is most of the time the methods take.
+
+# Money keeps the amount as an int number of cents (like rollback3.py onwards do), so adding, subtracting
+# and comparing are just int operations. Converting to Money gives EXACTLY what Decimal(x).quantize(Decimal('0.00'))
+# gives, including the rounding (ROUND_HALF_EVEN, the Decimal default, "banker's rounding"):
+#   Money.of(10.1)              -> 10.10   a float is converted from its exact binary value, like Decimal(10.1)
+#   Money.of(0.125)             -> 0.12    half way: rounded to the even cent
+#   Money.of("10.005")          -> 10.00   strings are parsed digit by digit, no float in between
+#   Money.of(Decimal("2.675"))  -> 2.68
+#   Money.of(7)                 -> 7.00
+# The conversion uses whole numbers only (float.as_integer_ratio / Decimal.as_integer_ratio), never a Decimal context.
+# Programs use the same few amounts over and over (10.1, 0.3, ...), so the cents for each float and str
+# are remembered in _CENTS_CACHE: converting an amount we have seen before is one dict lookup.
+
+# Money prints, formats, compares and hashes like the matching Decimal, so Money("10.10") == Decimal("10.10")
+# and they can be dictionary keys for each other. to_decimal() gives the Decimal when you really need one.
+# The one difference: an int has no negative zero, so an amount that rounds to zero from below prints
+# without the sign. Money.of(-0.001) prints 0.00 where Decimal(-0.001).quantize(Decimal('0.00')) prints -0.00
+# (they are still equal, and both are refused by deposit and withdraw).
+
+# money.Account is rollback4_Ref.Account with Money instead of Decimal. It prints the same lines and
+# returns values equal to the Decimal ones, so "from money import Account" can replace "from rollback4_Ref import Account".
+
+import re
+from decimal import Decimal, InvalidOperation
+from fractions import Fraction
+
+_NUMBER = re.compile(r"\s*([+-]?)(\d*)(?:\.(\d*))?(?:[eE]([+-]?\d+))?\s*\Z")
+
+_CENTS_CACHE = {}            # float or str amount -> cents
+_CENTS_CACHE_SIZE = 10000    # emptied when it gets bigger than this
+
+
+# n / d rounded to the nearest int, and to the even one when it is exactly half way (d > 0)
+def _round_half_even(n: int, d: int) -> int:
+    q, r = divmod(n, d)
+    if 2 * r > d or (2 * r == d and q % 2):
+        q += 1
+    return q
+
+
+def _cents_from_ratio(numerator: int, denominator: int) -> int:
+    return _round_half_even(numerator * 100, denominator)
+
+
+def _cents_from_string(text: str) -> int:
+    match = _NUMBER.match(text)
+    if match is None or not (match.group(2) or match.group(3)):
+        raise InvalidOperation("Invalid literal for Money: {!r}".format(text))
+    sign, whole, fraction, exponent = match.groups()
+    fraction = fraction or ""
+    digits = int(whole + fraction or "0")
+    scale = int(exponent or 0) - len(fraction) + 2  # value in cents is digits * 10 ** scale
+    if scale >= 0:
+        cents = digits * 10 ** scale
+    else:
+        cents = _round_half_even(digits, 10 ** -scale)
+    return -cents if sign == "-" else cents
+
+
+class Money(object):
+
+    __slots__ = ("cents",)
+
+    def __init__(self, value=0):
+        self.cents = Money._to_cents(value)
+
+    # Like Money(value), but doesn't make a new object if value is already Money
+    @staticmethod
+    def of(value) -> "Money":
+        if type(value) is Money:
+            return value
+        return Money._from_cents(Money._to_cents(value))
+
+    @staticmethod
+    def _from_cents(cents: int) -> "Money":
+        money = Money.__new__(Money)
+        money.cents = cents
+        return money
+
+    @staticmethod
+    def _to_cents(value) -> int:
+        kind = type(value)
+        if kind is int:
+            return value * 100
+        if kind is float or kind is str:
+            cents = _CENTS_CACHE.get(value)
+            if cents is None:
+                if kind is str:
+                    cents = _cents_from_string(value)
+                elif value != value or value in (float("inf"), float("-inf")):
+                    raise InvalidOperation("Money can't be {!r}".format(value))
+                else:
+                    cents = _cents_from_ratio(*value.as_integer_ratio())
+                if len(_CENTS_CACHE) >= _CENTS_CACHE_SIZE:
+                    _CENTS_CACHE.clear()
+                _CENTS_CACHE[value] = cents
+            return cents
+        if kind is Money:
+            return value.cents
+        if isinstance(value, Decimal):
+            if not value.is_finite():
+                raise InvalidOperation("Money can't be {!r}".format(value))
+            return _cents_from_ratio(*value.as_integer_ratio())
+        if isinstance(value, int):  # bool and other int subclasses
+            return int(value) * 100
+        if isinstance(value, Fraction):
+            return _cents_from_ratio(value.numerator, value.denominator)
+        raise TypeError("Can't convert {} to Money".format(kind.__name__))
+
+    def to_decimal(self) -> Decimal:
+        return Decimal(self.cents).scaleb(-2)
+
+    def __str__(self) -> str:
+        cents = self.cents
+        sign = "-" if cents < 0 else ""
+        units, cents = divmod(abs(cents), 100)
+        return "{}{}.{:02d}".format(sign, units, cents)
+
+    def __repr__(self) -> str:
+        return "Money('{}')".format(self)
+
+    def __format__(self, spec: str) -> str:
+        return str(self) if not spec else format(self.to_decimal(), spec)
+
+    def __float__(self) -> float:
+        return self.cents / 100
+
+    def __bool__(self) -> bool:
+        return self.cents != 0
+
+    # Same hash as the equal Decimal (and the equal int, when there are no cents)
+    def __hash__(self) -> int:
+        if self.cents % 100 == 0:
+            return hash(self.cents // 100)
+        return hash(Fraction(self.cents, 100))
+
+    def __neg__(self) -> "Money":
+        return Money._from_cents(-self.cents)
+
+    def __pos__(self) -> "Money":
+        return self
+
+    def __abs__(self) -> "Money":
+        return Money._from_cents(abs(self.cents))
+
+    def __add__(self, other) -> "Money":
+        if type(other) is Money:
+            return Money._from_cents(self.cents + other.cents)
+        if isinstance(other, (int, Decimal)):
+            return Money._from_cents(self.cents + Money._to_cents(other))
+        return NotImplemented
+
+    __radd__ = __add__
+
+    def __sub__(self, other) -> "Money":
+        if type(other) is Money:
+            return Money._from_cents(self.cents - other.cents)
+        if isinstance(other, (int, Decimal)):
+            return Money._from_cents(self.cents - Money._to_cents(other))
+        return NotImplemented
+
+    def __rsub__(self, other) -> "Money":
+        if isinstance(other, (int, Decimal)):
+            return Money._from_cents(Money._to_cents(other) - self.cents)
+        return NotImplemented
+
+    # Money * int is exact. Money * Decimal is rounded to the cent like Decimal.quantize would.
+    def __mul__(self, other) -> "Money":
+        if isinstance(other, int):
+            return Money._from_cents(self.cents * other)
+        if isinstance(other, Decimal) and other.is_finite():
+            numerator, denominator = other.as_integer_ratio()
+            return Money._from_cents(_round_half_even(self.cents * numerator, denominator))
+        return NotImplemented
+
+    __rmul__ = __mul__
+
+    # The exact value, for comparing with anything else (Decimal, float, int, Fraction)
+    def _exact(self) -> Fraction:
+        return Fraction(self.cents, 100)
+
+    def _compare(self, other, test):
+        if type(other) is Money:
+            return test(self.cents, other.cents)
+        if isinstance(other, int):
+            return test(self.cents, other * 100)
+        if isinstance(other, (Decimal, float, Fraction)):
+            return test(self._exact(), Fraction(other) if isinstance(other, Decimal) else other)
+        return NotImplemented
+
+    def __eq__(self, other):
+        return self._compare(other, lambda a, b: a == b)
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    def __lt__(self, other):
+        return self._compare(other, lambda a, b: a < b)
+
+    def __le__(self, other):
+        return self._compare(other, lambda a, b: a <= b)
+
+    def __gt__(self, other):
+        return self._compare(other, lambda a, b: a > b)
+
+    def __ge__(self, other):
+        return self._compare(other, lambda a, b: a >= b)
+
+
+Money.ZERO = Money._from_cents(0)
+
+
+# rollback4_Ref.Account, with Money instead of Decimal
+class Account(object):
+    _qb = Money.ZERO  # class constant, accessible without creating an instance.
+
+    def __init__(self, name: str, opening_balance: float = 0.0):
+        self.name = name
+        self._balance = Money.of(opening_balance)
+        print("Account created for {}. ".format(self.name), end='')
+        self.show_balance()
+
+    def deposit(self, amount: float) -> Money:
+        cents = Money._to_cents(amount)
+        if cents > 0:
+            self._balance = Money._from_cents(self._balance.cents + cents)
+            print("{} deposited".format(Money._from_cents(cents)))
+        return self._balance
+
+    def withdraw(self, amount: float) -> Money:
+        cents = Money._to_cents(amount)
+        if 0 < cents <= self._balance.cents:
+            self._balance = Money._from_cents(self._balance.cents - cents)
+            money_amount = Money._from_cents(cents)
+            print("{} withdrawn".format(money_amount))
+            return money_amount
+        else:
+            print("The amount must be greater than zero and no more than your account balance")
+            return Account._qb
+
+    def show_balance(self):
+        print("Balance on account {} is {}".format(self.name, self._balance))
+
+
+if __name__ == '__main__':
+    import contextlib
+    import io
+    import timeit
+
+    import rollback4_Ref
+
+    # Same answers as Decimal(x).quantize(Decimal('0.00'))
+    for value in (10.1, 0.1, 0.125, 0.135, 2.675, -2.675, "10.005", "10.015", "1e3", "-0.5", Decimal("2.675"), 7):
+        decimal = Decimal(value).quantize(Decimal("0.00"))
+        money = Money.of(value)
+        assert money == decimal and str(money) == str(decimal), (value, money, decimal)
+
+    tim = Account("Tim")
+    tim.deposit(10.1)
+    tim.deposit(0.1)
+    tim.deposit(0.1)
+    tim.withdraw(0.3)
+    tim.withdraw(0)
+    tim.show_balance()
+
+    print("=" * 80)
+    x = tim.withdraw(900)
+    print(x)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        decimal_account = rollback4_Ref.Account("Decimal", 1000000)
+        money_account = Account("Money", 1000000)
+        decimal_time = timeit.timeit(lambda: (decimal_account.deposit(10.1), decimal_account.withdraw(0.3)),
+                                     number=20000)
+        money_time = timeit.timeit(lambda: (money_account.deposit(10.1), money_account.withdraw(0.3)),
+                                   number=20000)
+    print("Decimal: {:.3f}s  Money: {:.3f}s  for 20000 deposits and withdrawals".format(decimal_time, money_time))
+    decimal_time = timeit.timeit(lambda: Decimal(10.1).quantize(rollback4_Ref.Account._qb), number=200000)
+    money_time = timeit.timeit(lambda: Money.of(10.1), number=200000)
+    print("Decimal: {:.3f}s  Money: {:.3f}s  for 200000 conversions of 10.1".format(decimal_time, money_time))
+    assert money_account._balance == decimal_account._balance
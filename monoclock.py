@@ -0,0 +1,114 @@
+
+# =======================================================
+# Monotonic, collision free history timestamps
+# =======================================================
+
+# ==============
+# monoclock.py
+# ==============
+
+# The history table's primary key is (time, account).
+# Account._current_time() used datetime.utcnow(), so two operations on the same account in the same clock tick
+# got the same time, raised IntegrityError, and rollback7 rolled the second one back (the deposit was lost).
+# That is the CHANGE_1 test from rollback7.py, but it also happens by itself when we are busy.
+
+# MonotonicClock works like a hybrid logical clock, with one sequence per account:
+# it normally returns the wall clock time in microseconds, but if that is not later than the last time
+# it gave out for the same account, it returns last time + 1 microsecond instead.
+# So times for one account always go up, and there is no need to retry.
+
+# Only accounts whose last time is still ahead of the wall clock need to be remembered,
+# so the dictionary is cleaned out when it gets big.
+
+# NOTE: this guarantees unique times inside one process. Two processes writing the same account
+# can still collide, and then the IntegrityError rollback in _save_update still protects the data.
+
+import datetime
+import threading
+import time
+
+import pytz
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=pytz.utc)
+
+# The two ways history.time can be stored (see rollback7.create_schema)
+TIMESTAMP = "TIMESTAMP"
+EPOCH_US = "INTEGER"
+
+
+class MonotonicClock(object):
+
+    def __init__(self, max_tracked: int = 100000):
+        self.max_tracked = max_tracked
+        self._last = {}  # account name -> last time given out (microseconds since the epoch)
+        self._wall_clock = 0  # latest wall clock time seen, so the clock never goes backwards
+        self._prune_at = max_tracked
+        self._lock = threading.Lock()
+
+    def now_us(self, account: str = None) -> int:
+        now = _wall_clock_us()
+        with self._lock:
+            if now < self._wall_clock:
+                now = self._wall_clock  # the system clock was set back
+            else:
+                self._wall_clock = now
+            last = self._last.get(account)
+            if last is not None and now <= last:
+                now = last + 1
+            self._last[account] = now
+            if len(self._last) > self._prune_at:
+                self._forget_old()
+        return now
+
+    def now(self, account: str = None) -> datetime.datetime:
+        return from_us(self.now_us(account))
+
+    # Times that are already behind the wall clock can never be handed out again, so we don't need them
+    def _forget_old(self):
+        self._last = {account: last for account, last in self._last.items() if last >= self._wall_clock}
+        self._prune_at = max(self.max_tracked, 2 * len(self._last))
+
+
+def _wall_clock_us() -> int:
+    return int(time.time() * 1000000)
+
+
+# microseconds since the epoch -> aware UTC datetime
+def from_us(microseconds: int) -> datetime.datetime:
+    return EPOCH + datetime.timedelta(microseconds=microseconds)
+
+
+# The text sqlite3 stores for an aware datetime ("2018-07-04 14:14:31.203132+00:00") -> aware UTC datetime
+def parse_timestamp(text: str) -> datetime.datetime:
+    if isinstance(text, bytes):
+        text = text.decode()
+    moment = datetime.datetime.strptime(text[:19], "%Y-%m-%d %H:%M:%S")
+    rest = text[19:]
+    if rest.startswith("."):
+        digits = rest[1:7]
+        moment = moment.replace(microsecond=int(digits.ljust(6, "0")))
+        rest = rest[1 + len(digits):]
+    moment = pytz.utc.localize(moment)
+    if rest:  # a "+hh:mm" offset
+        sign = -1 if rest[0] == "-" else 1
+        hours, minutes = rest[1:].split(":")
+        moment -= sign * datetime.timedelta(hours=int(hours), minutes=int(minutes))
+    return moment
+
+
+# aware datetime -> microseconds since the epoch
+def to_us(moment: datetime.datetime) -> int:
+    delta = moment - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+# A datetime, or microseconds since 1970, in the format a time column is stored in (so we can compare with it)
+def storage_time(moment, time_format: str):
+    if isinstance(moment, int):
+        return moment if time_format == EPOCH_US else from_us(moment)
+    if time_format == EPOCH_US:
+        return to_us(moment)
+    return moment.astimezone(pytz.utc)
+
+
+clock = MonotonicClock()
@@ -0,0 +1,145 @@
+
+# =======================================================
+# Idempotency keys
+# =======================================================
+
+# ==================
+# operationkeys.py
+# ==================
+
+# A client that times out waiting for deposit() doesn't know if the deposit was saved.
+# If it just calls deposit() again, the money may be deposited twice.
+
+# Instead the client makes up a key for the operation (a uuid for example) and sends the same key
+# every time it retries: john.deposit(1000, key="9f1c...").
+# The key is saved in operation_keys in the same transaction as the deposit:
+#   operation_keys (key TEXT PRIMARY KEY, applied INTEGER, time INTEGER)
+#   applied is 1 if the operation was saved and 0 if it was refused, time is when (microseconds since 1970)
+# so a retry with a key we already have is not run again, it just gets the first result back.
+
+# Most keys are new, so looking every key up in the table would be a wasted disk read.
+# OperationKeys keeps a bloom filter of the keys in the table: a bit array where each key sets a few bits.
+# If any of a key's bits is 0 the key is definitely not in the table and we skip the SELECT.
+# (If they are all 1 it PROBABLY is, and we check with the SELECT.)
+# The PRIMARY KEY is what really stops a key being saved twice; the bloom filter only saves reads.
+# Another pool or process can add keys to the same file behind our back. When "PRAGMA data_version" says
+# another connection has committed (like balancecache.py checks), the lookup doesn't trust the bloom filter
+# and does the SELECT, and the keys saved since we last looked are added to the filter
+# ("WHERE time >= ...", which uses the operation_keys_time index), instead of reading the whole table again.
+# A key's time is taken inside its write transaction, before the commit, so we look _SLACK_US (longer than
+# any transaction that saves keys) further back than our last look.
+
+# Keys are kept for ttl seconds (a day by default), which must be longer than any client keeps retrying
+# (and longer than journal.py's journal lives). prune() deletes older ones and rebuilds the bloom filter.
+
+import hashlib
+import math
+import sqlite3
+import time
+
+_SLACK_US = 5 * 1000000
+
+
+def now_us() -> int:
+    return int(time.time() * 1000000)
+
+
+class BloomFilter(object):
+
+    # capacity keys with about error_rate false positives
+    def __init__(self, capacity: int = 1000000, error_rate: float = 0.01):
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))  # number of bits
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self._bits = bytearray((self.size + 7) // 8)
+
+    # k bit positions from two 64 bit hashes (h1 + i * h2, "double hashing")
+    def _positions(self, key: str):
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key: str):
+        for position in self._positions(key):
+            self._bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key: str) -> bool:
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+    def clear(self):
+        self._bits = bytearray(len(self._bits))
+
+
+class OperationKeys(object):
+
+    def __init__(self, ttl: float = 86400, capacity: int = 1000000, error_rate: float = 0.01):
+        self.ttl = ttl
+        self._bloom = BloomFilter(capacity, error_rate)
+        self._loaded = False
+        self._data_version = None  # of the connection, when the bloom filter was last brought up to date
+        self._synced = None        # now_us() when the bloom filter was last brought up to date
+        self._next_prune = None  # time.monotonic() of the next prune
+        self.skipped = 0         # lookups answered by the bloom filter alone
+        self.lookups = 0         # lookups that had to read the table
+
+    def _load(self, db: sqlite3.Connection):
+        self._data_version = db.execute("PRAGMA data_version").fetchone()[0]
+        self._synced = now_us()
+        self._bloom.clear()
+        for key, in db.execute("SELECT key FROM operation_keys"):
+            self._bloom.add(key)
+        self._loaded = True
+
+    # Adds the keys other connections have saved since we last looked
+    def _catch_up(self, db: sqlite3.Connection, data_version: int):
+        synced = now_us()
+        for key, in db.execute("SELECT key FROM operation_keys WHERE (time >= ?)", (self._synced - _SLACK_US,)):
+            self._bloom.add(key)
+        self._data_version = data_version
+        self._synced = synced
+
+    # None if we haven't seen the key (within ttl), otherwise True/False: the result it had the first time
+    # Call it with the pool's writer connection, data_version is different for each connection.
+    def lookup(self, db: sqlite3.Connection, key: str):
+        if not self._loaded:
+            self._load(db)
+        data_version = db.execute("PRAGMA data_version").fetchone()[0]
+        if data_version != self._data_version:
+            self._catch_up(db, data_version)  # and don't trust the bloom filter this time
+        elif key not in self._bloom:
+            self.skipped += 1
+            return None
+        self.lookups += 1
+        row = db.execute("SELECT applied FROM operation_keys WHERE (key = ?)", (key,)).fetchone()
+        return None if row is None else bool(row[0])
+
+    # Call inside the transaction that saves the operation
+    def save(self, db: sqlite3.Connection, key: str, applied: bool):
+        self.save_many(db, [(key, applied)])
+
+    def save_many(self, db: sqlite3.Connection, keys: list):
+        saved = now_us()
+        db.executemany("INSERT INTO operation_keys (key, applied, time) VALUES(?, ?, ?)",
+                       [(key, int(applied), saved) for key, applied in keys])
+        for key, _ in keys:
+            self._bloom.add(key)  # if the transaction is rolled back this is just a false positive
+
+    # Deletes keys older than ttl. Like ZoneTable.intern this commits, so call it outside a transaction.
+    # Only does anything every ttl / 10 seconds, so it's cheap to call before every write.
+    def prune(self, db: sqlite3.Connection, force: bool = False) -> int:
+        if not force and self._next_prune is not None and time.monotonic() < self._next_prune:
+            return 0
+        self._next_prune = time.monotonic() + self.ttl / 10
+        deleted = db.execute("DELETE FROM operation_keys WHERE (time < ?)",
+                             (now_us() - int(self.ttl * 1000000),)).rowcount
+        db.commit()
+        if deleted or not self._loaded:
+            self._load(db)  # a bloom filter can't forget keys, so start it again
+        return deleted
+
+    def clear(self):
+        self._bloom.clear()
+        self._loaded = False
+        self._data_version = None
+        self._synced = None
+        self._next_prune = None
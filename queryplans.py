@@ -0,0 +1,78 @@
+
+# =======================================================
+# Checking that history queries use the indexes
+# =======================================================
+
+# ===============
+# queryplans.py
+# ===============
+
+# EXPLAIN QUERY PLAN tells us how SQLite will run a query.
+#   "SEARCH history USING INDEX history_account_time (account=? AND time>?)"  - good, only the rows we need
+#   "SCAN history"                                                           - bad, the whole table is read
+#   "USE TEMP B-TREE FOR ORDER BY"                                           - bad, all the rows are sorted first
+
+# check_query_plans runs EXPLAIN QUERY PLAN for the per-account and time range queries we use
+# (stream_history in history.py, and the localhistory view) and raises AssertionError if any of them
+# would scan or sort the history table, or doesn't use the index we expect.
+# Run it after changing the schema or the queries:
+
+#   python queryplans.py accounts.sqlite
+
+import sqlite3
+import sys
+
+from rollback7 import create_schema
+
+# name -> (sql, parameters, index the plan must use)
+QUERIES = {
+    "account history": (
+        "SELECT time, account, amount, zone FROM history WHERE (account = ?) AND (time > ?) ORDER BY time LIMIT ?",
+        ("John", 0, 1000), "history_account_time"),
+    "account history in a time range": (
+        "SELECT time, account, amount, zone FROM history WHERE (account = ?) AND (time >= ?) AND (time < ?)"
+        " ORDER BY time LIMIT ?",
+        ("John", 0, 1, 1000), "history_account_time"),
+    "time range": (
+        "SELECT time, account, amount, zone FROM history WHERE (time >= ?) AND (time < ?)"
+        " AND ((time, account) > (?, ?)) ORDER BY time, account LIMIT ?",
+        (0, 1, 0, "", 1000), None),
+    "account total": (
+        "SELECT SUM(amount) FROM history WHERE (account = ?)",
+        ("John",), "history_account_time"),
+    "localhistory for one account": (
+        "SELECT * FROM localhistory WHERE (account = ?)",
+        ("John",), "history_account_time"),
+}
+
+_BAD = ("SCAN history", "SCAN TABLE history", "USE TEMP B-TREE")
+
+
+def query_plan(db: sqlite3.Connection, sql: str, parameters=()) -> list:
+    return [row[-1] for row in db.execute("EXPLAIN QUERY PLAN " + sql, parameters)]
+
+
+def check_query_plans(db: sqlite3.Connection, queries: dict = None) -> dict:
+    queries = queries if queries is not None else QUERIES
+    plans = {}
+    problems = []
+    for name, (sql, parameters, index) in queries.items():
+        plans[name] = plan = query_plan(db, sql, parameters)
+        for detail in plan:
+            if detail.startswith(_BAD):
+                problems.append("{}: {}".format(name, detail))
+        if index is not None and not any(index in detail for detail in plan):
+            problems.append("{}: does not use {} ({})".format(name, index, "; ".join(plan)))
+    if problems:
+        raise AssertionError("History queries that don't use an index:\n" + "\n".join(problems))
+    return plans
+
+
+if __name__ == '__main__':
+    database = sys.argv[1] if len(sys.argv) > 1 else "accounts.sqlite"
+    db = sqlite3.connect(database)
+    create_schema(db)  # makes sure the indexes exist
+    db.commit()
+    for name, plan in check_query_plans(db).items():
+        print("{}: {}".format(name, "; ".join(plan)))
+    db.close()
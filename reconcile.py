@@ -0,0 +1,124 @@
+
+# =======================================================
+# Reconciling accounts with history
+# =======================================================
+
+# ==============
+# reconcile.py
+# ==============
+
+# The rollback in rollback7._save_update is there so that accounts.balance and the history rows never disagree.
+# reconcile() checks it: for every account, accounts.balance must equal SUM(history.amount).
+# (Account.__init__ saves the opening balance as a history row, so it is part of the SUM.
+#  Accounts created before that change will show their opening balance as the difference.)
+
+# How it works:
+#   - both tables are read sorted by account name, and merged like two sorted lists (a "sorted merge"),
+#     so we only ever hold one account of each in memory, whatever the size of the tables
+#   - the names are split into ranges ("shards") and each shard is checked by its own process
+#     with its own read connection, so all the cores are used
+
+#   python reconcile.py accounts.sqlite
+
+import multiprocessing
+import os
+import sqlite3
+import sys
+
+_SENTINEL = (None, None)
+
+
+# Splits the account names into "shards" ranges of about the same size.
+# Returns a list of (first name, end name) where None means "no limit".
+def shard_ranges(db: sqlite3.Connection, shards: int) -> list:
+    count = db.execute("SELECT COUNT(*) FROM accounts").fetchone()[0]
+    shards = max(1, min(shards, count))
+    bounds = [None]
+    for shard in range(1, shards):
+        row = db.execute("SELECT name FROM accounts ORDER BY name LIMIT 1 OFFSET ?",
+                         (count * shard // shards,)).fetchone()
+        if row is not None and row[0] != bounds[-1]:
+            bounds.append(row[0])
+    bounds.append(None)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _between(column: str, first, end) -> tuple:
+    conditions = []
+    parameters = []
+    if first is not None:
+        conditions.append("({} >= ?)".format(column))
+        parameters.append(first)
+    if end is not None:
+        conditions.append("({} < ?)".format(column))
+        parameters.append(end)
+    return " AND ".join(conditions) or "1", parameters
+
+
+# Checks one range of names. Returns (accounts checked, list of (name, balance, history total)).
+# balance is None for an account that only exists in history, and the total is 0 for an account without history.
+def reconcile_range(database: str, first=None, end=None, max_report: int = 1000) -> tuple:
+    db = sqlite3.connect(database)
+    try:
+        where, parameters = _between("name", first, end)
+        accounts = db.execute("SELECT name, balance FROM accounts WHERE {} ORDER BY name".format(where), parameters)
+        where, parameters = _between("account", first, end)
+        totals = db.execute("SELECT account, SUM(amount) FROM history WHERE {}"
+                            " GROUP BY account ORDER BY account".format(where), parameters)
+
+        checked = 0
+        mismatches = []
+        name, balance = next(accounts, _SENTINEL)
+        account, total = next(totals, _SENTINEL)
+        while name is not None or account is not None:
+            if account is None or (name is not None and name < account):
+                row = (name, balance, 0)  # no history at all
+                name, balance = next(accounts, _SENTINEL)
+            elif name is None or account < name:
+                row = (account, None, total)  # history for an account that doesn't exist
+                account, total = next(totals, _SENTINEL)
+            else:
+                row = (name, balance, total)
+                name, balance = next(accounts, _SENTINEL)
+                account, total = next(totals, _SENTINEL)
+            checked += 1
+            if row[1] != row[2] and len(mismatches) < max_report:
+                mismatches.append(row)
+        return checked, mismatches
+    finally:
+        db.close()
+
+
+def _reconcile_range(arguments: tuple) -> tuple:
+    return reconcile_range(*arguments)
+
+
+def reconcile(database: str = "accounts.sqlite", shards: int = None, max_report: int = 1000) -> tuple:
+    shards = shards if shards is not None else os.cpu_count() or 1
+    db = sqlite3.connect(database)
+    try:
+        ranges = shard_ranges(db, shards)
+    finally:
+        db.close()
+
+    jobs = [(database, first, end, max_report) for first, end in ranges]
+    if len(jobs) == 1:
+        results = [_reconcile_range(jobs[0])]
+    else:
+        with multiprocessing.Pool(len(jobs)) as pool:
+            results = pool.map(_reconcile_range, jobs)
+
+    checked = sum(result[0] for result in results)
+    mismatches = [row for result in results for row in result[1]][:max_report]
+    return checked, mismatches
+
+
+if __name__ == '__main__':
+    database = sys.argv[1] if len(sys.argv) > 1 else "accounts.sqlite"
+    checked, mismatches = reconcile(database)
+    for name, balance, total in mismatches:
+        if balance is None:
+            print("{}: has history totalling {:.2f} but no account".format(name, total / 100))
+        else:
+            print("{}: balance {:.2f} but history adds up to {:.2f}".format(name, balance / 100, total / 100))
+    print("{} accounts checked, {} mismatches".format(checked, len(mismatches)))
@@ -26,53 +26,317 @@ import sqlite3
 import datetime
 import pytz
 
-db = sqlite3.connect("accounts.sqlite")
-db.execute("CREATE TABLE IF NOT EXISTS accounts (name TEXT PRIMARY KEY NOT NULL, balance INTEGER NOT NULL)")
-db.execute("CREATE TABLE IF NOT EXISTS history (time TIMESTAMP NOT NULL,"
-           " account TEXT NOT NULL, amount INTEGER NOT NULL, PRIMARY KEY (time, account))")
+from connpool import ConnectionPool
+from events import console
+from monoclock import EPOCH_US, TIMESTAMP, clock
+from operationkeys import OperationKeys
+from snapshots import Snapshots
+from zones import ZoneTable
+
+
+# The tables are created when the pool opens its writer connection, instead of at import time.
+# Account objects take a ConnectionPool (see connpool.py) instead of sharing one global "db" connection.
+
+# history.time can be stored in two ways:
+#   TIMESTAMP - the aware datetime, which sqlite3 saves as an ISO string (this is what we have always done)
+#   EPOCH_US  - an INTEGER number of microseconds since 1970. Smaller and much faster to read back.
+# time_format is only used when the history table is created. For an existing file we look at the declared
+# type of history.time, so old files keep working. Use migratedb.py to convert an old file to EPOCH_US.
+# To create new files with integer times: ConnectionPool(on_create=functools.partial(create_schema, time_format=EPOCH_US))
+
+# history.zone is the id of the local time zone in the "zones" table (see zones.py), so the original
+# local time can be rebuilt. Older rollback7 files get the column added (NULL means no zone was saved).
+
+# The CREATE statements only run when the file's "PRAGMA user_version" is not SCHEMA_VERSION, so opening
+# a file that is already up to date is one PRAGMA instead of a dozen statements.
+# Add 1 to SCHEMA_VERSION whenever the tables, indexes or views below change, so old files are brought up to date.
+SCHEMA_VERSION = 1
+
+
+def create_schema(db: sqlite3.Connection, time_format: str = TIMESTAMP) -> dict:
+    if db.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+        create_tables(db, time_format)
+        db.execute("PRAGMA user_version = {}".format(SCHEMA_VERSION))
+    return {"time_format": history_time_format(db), "zones": ZoneTable(), "snapshots": Snapshots(),
+            "keys": OperationKeys()}
+
+
+def create_tables(db: sqlite3.Connection, time_format: str = TIMESTAMP):
+    db.execute("CREATE TABLE IF NOT EXISTS accounts (name TEXT PRIMARY KEY NOT NULL, balance INTEGER NOT NULL)")
+    db.execute("CREATE TABLE IF NOT EXISTS zones (id INTEGER PRIMARY KEY, utcoffset INTEGER NOT NULL,"
+               " name TEXT NOT NULL, UNIQUE (utcoffset, name))")
+    db.execute("CREATE TABLE IF NOT EXISTS history (time {} NOT NULL,"
+               " account TEXT NOT NULL, amount INTEGER NOT NULL, zone INTEGER REFERENCES zones (id),"
+               " PRIMARY KEY (time, account))".format(time_format))
+    if "zone" not in [column[1] for column in db.execute("PRAGMA table_info(history)")]:
+        db.execute("ALTER TABLE history ADD COLUMN zone INTEGER REFERENCES zones (id)")
+    time_format = history_time_format(db)
+    # balance checkpoints (see snapshots.py), with the same time format as history
+    db.execute("CREATE TABLE IF NOT EXISTS snapshots (account TEXT NOT NULL, time {} NOT NULL,"
+               " balance INTEGER NOT NULL, PRIMARY KEY (account, time))".format(time_format))
+    # transfers between two database files (see transfers.py): the sending side keeps each transfer until
+    # the receiving side has it, and the receiving side remembers the ids it has applied
+    db.execute("CREATE TABLE IF NOT EXISTS transfers_out (id TEXT PRIMARY KEY NOT NULL, account TEXT NOT NULL,"
+               " to_database TEXT NOT NULL, to_account TEXT NOT NULL, amount INTEGER NOT NULL,"
+               " done INTEGER NOT NULL DEFAULT 0)")
+    db.execute("CREATE TABLE IF NOT EXISTS transfers_in (id TEXT PRIMARY KEY NOT NULL)")
+    # the key of every operation that came with one (see operationkeys.py and journal.py), saved in the same
+    # transaction as the operation, with 1 if it was applied or 0 if it was refused, so it is never run a second time
+    db.execute("CREATE TABLE IF NOT EXISTS operation_keys (key TEXT PRIMARY KEY NOT NULL,"
+               " applied INTEGER NOT NULL, time INTEGER NOT NULL DEFAULT 0)")
+    if "time" not in [column[1] for column in db.execute("PRAGMA table_info(operation_keys)")]:
+        db.execute("ALTER TABLE operation_keys ADD COLUMN time INTEGER NOT NULL DEFAULT 0")
+    create_indexes(db, time_format)
+
+
+# The (time, account) primary key is no help for "history for one account", because account is the second column.
+# history_account_time gives us per-account history in time order without scanning the whole table.
+# queryplans.py checks with EXPLAIN QUERY PLAN that our queries really use these indexes.
+
+# We can't make an expression index for the localhistory view: strftime(..., 'localtime') depends on
+# the machine's time zone, and SQLite only allows deterministic expressions in an index.
+# A WHERE on the view's "account" column is pushed down into the view and uses history_account_time.
+def create_indexes(db: sqlite3.Connection, time_format: str = TIMESTAMP):
+    db.execute("CREATE INDEX IF NOT EXISTS history_account_time ON history (account, time)")
+    db.execute("CREATE INDEX IF NOT EXISTS operation_keys_time ON operation_keys (time)")  # for pruning old keys
+    if time_format == EPOCH_US:
+        local_time = "strftime('%Y-%m-%d %H:%M:%f', history.time / 1000000.0, 'unixepoch', 'localtime')"
+    else:
+        local_time = "strftime('%Y-%m-%d %H:%M:%f', history.time, 'localtime')"
+    db.execute("CREATE VIEW IF NOT EXISTS localhistory AS SELECT {} AS localtime, history.account, history.amount"
+               " FROM history ORDER BY history.time".format(local_time))
+
+
+def history_time_format(db: sqlite3.Connection) -> str:
+    for column in db.execute("PRAGMA table_info(history)"):
+        if column[1] == "time":
+            return EPOCH_US if column[2].upper() == EPOCH_US else TIMESTAMP
+    return TIMESTAMP
+
+
+default_pool = ConnectionPool("accounts.sqlite", on_create=create_schema)
+
+
+# CHANGE_8: Account doesn't print any more, it sends events to the pool's sink (see events.py).
+# With no sink they are printed just like before.
+def _events(pool: ConnectionPool):
+    return pool.events if pool.events is not None else console
 
 
 class Account(object):
 
+    # CHANGE_7: no __dict__ for each Account, just these three fields (about 3 times smaller).
+    # For millions of accounts use accounttable.AccountTable instead.
+    __slots__ = ("name", "_balance", "_pool")
+
     # We change _current_time module back to not using "astimezone()"
+    # CHANGE_3: the time comes from a monotonic clock (see monoclock.py), so two updates to the same
+    # account can never get the same time and be rolled back by the IntegrityError
+    # CHANGE_4: returns an int instead of a datetime when the history table uses EPOCH_US
     @staticmethod
-    def _current_time():
-        return pytz.utc.localize(datetime.datetime.utcnow())
+    def _current_time(account_name: str = None, time_format: str = TIMESTAMP):
+        if time_format == EPOCH_US:
+            return clock.now_us(account_name)
+        return clock.now(account_name)
+        # return pytz.utc.localize(datetime.datetime.utcnow())
         # return 1   # CHANGE_1. This is for testing
 
 
 
-    def __init__(self, name: str, opening_balance: int = 0):
-        cursor = db.execute("SELECT name, balance FROM accounts WHERE (name = ?)", (name,))
-        row = cursor.fetchone()
+    def __init__(self, name: str, opening_balance: int = 0, pool: ConnectionPool = None):
+        self._pool = pool if pool is not None else default_pool
+        probe = self._pool.probe  # see instruments.py, None unless we are timing the operations
+        if probe is not None:
+            started = probe.clock()
+
+        # Hot accounts come straight from the pool's balance cache, without a SELECT
+        with self._pool.writing() as db:
+            balances = self._pool.balances
+            balances.validate(db)
+            balance = balances.load(db, name)
+            if balance is None:
+                try:
+                    Account._open(self._pool, db, [(name, opening_balance)], self._pool.schema["zones"].intern(db))
+                except BaseException:
+                    db.rollback()  # never leave the pool's writer inside a transaction
+                    self._pool.schema["snapshots"].forget([name])
+                    raise
+                db.commit()
+                balances.put(name, opening_balance)
 
-        if row:
-            self.name, self._balance = row
-            print("Retrieved record for {}. ".format(self.name), end='')
+        self.name = name
+        if balance is not None:
+            self._balance = balance
+            _events(self._pool).emit("retrieved", name, None, balance)
         else:
-            self.name = name
             self._balance = opening_balance
-            cursor.execute("INSERT INTO accounts VALUES(?, ?)", (name, opening_balance))
-            cursor.connection.commit()
-            print("Account created for {}. ".format(self.name), end='')
-        self.show_balance()
+            _events(self._pool).emit("created", name, None, opening_balance)
+        if probe is not None:
+            probe.lap("account.init", started)
 
-    def _save_update(self, amount):
-        new_balance = self._balance + amount
-        deposit_time = Account._current_time()
+    # Inserts new accounts, from a list of (name, opening_balance). The opening balance is also saved in history,
+    # so that accounts.balance is always the SUM of the account's history amounts (reconcile.py checks this).
+    # Each account also gets its first balance snapshot.
+    @staticmethod
+    def _open(pool: ConnectionPool, db: sqlite3.Connection, created: list, zone: int):
+        time_format = pool.schema["time_format"]
+        opened = [(name, Account._current_time(name, time_format), balance) for name, balance in created]
+        statements = pool.statements
+        statements.executemany("insert_account", created)
+        statements.executemany("insert_history", [(opening_time, name, balance, zone)
+                                                  for name, opening_time, balance in opened if balance])
+        pool.schema["snapshots"].opened(db, opened)
 
-        # CHANGE_2: code for rolling back if error is found.
-        try:   # CHANGE_2
-            db.execute("UPDATE accounts SET balance = ? WHERE (name = ?)", (new_balance, self.name))
-            db.execute("INSERT INTO history VALUES(?, ?, ?)", (deposit_time, self.name, amount))
-        except sqlite3.Error:
-            db.rollback()  # Rollback if you get an error
-        else:
-            db.commit()  # Commits if no error is found
-            self._balance = new_balance  # Then updates the balance
+    # Opens lots of accounts at once: load_many([("TerryJ", 0), ("Graham", 9000)]) or load_many({"Graham": 9000})
+    # Existing accounts are fetched with a few "IN (...)" queries, and the missing ones are inserted
+    # with one executemany in a single transaction. Returns the Account objects in the same order as the names.
+    _IN_CHUNK = 500  # keeps us below SQLite's limit on the number of ? in one statement
+
+    @classmethod
+    def load_many(cls, names_with_opening_balances, pool: ConnectionPool = None) -> list:
+        pool = pool if pool is not None else default_pool
+        if isinstance(names_with_opening_balances, dict):
+            names_with_opening_balances = names_with_opening_balances.items()
+        requested = list(names_with_opening_balances)
+        opening_balances = {}
+        for name, opening_balance in requested:
+            opening_balances.setdefault(name, opening_balance)
+
+        with pool.writing() as db:
+            balances = pool.balances
+            try:
+                zone = pool.schema["zones"].intern(db)
+                db.execute("BEGIN IMMEDIATE")
+                balances.validate(db)
+                found = {}
+                missing = []
+                for name in opening_balances:
+                    balance = balances.get(name)
+                    if balance is None:
+                        missing.append(name)
+                    else:
+                        found[name] = balance
+
+                for start in range(0, len(missing), cls._IN_CHUNK):
+                    chunk = missing[start:start + cls._IN_CHUNK]
+                    cursor = db.execute("SELECT name, balance FROM accounts WHERE name IN ({})"
+                                        .format(", ".join("?" * len(chunk))), chunk)
+                    found.update(cursor)
 
+                created = [(name, opening_balances[name]) for name in missing if name not in found]
+                Account._open(pool, db, created, zone)
+            except BaseException:
+                db.rollback()
+                pool.schema["snapshots"].forget(opening_balances)
+                raise
+            else:
+                db.commit()
+            found.update(created)
+            for name, balance in found.items():
+                balances.put(name, balance)
 
-    def deposit(self, amount: int) -> float:
+        accounts = {}
+        for name, balance in found.items():
+            account = cls.__new__(cls)
+            account._pool = pool
+            account.name = name
+            account._balance = balance
+            accounts[name] = account
+        _events(pool).emit("loaded", None, len(found) - len(created), len(created))
+        return [accounts[name] for name, _ in requested]
+
+    # Returns True if the update was saved.
+    # BEGIN IMMEDIATE takes the database write lock BEFORE we check the balance cache, so nobody else
+    # (not even another process) can change the balance between our check and our UPDATE.
+    # That way a stale _balance can never approve a withdrawal that overdraws the account.
+    # CHANGE_5: with an idempotency key (see operationkeys.py) an operation that was already done
+    # is not done again, we just return the result it had the first time
+    def _save_update(self, amount, key: str = None) -> bool:
+        probe = self._pool.probe
+        if probe is None:
+            return self._save(amount, key, None)
+        started = probe.clock()
+        try:
+            return self._save(amount, key, probe)
+        finally:
+            probe.lap("save_update", started)
+
+    # CHANGE_6: "probe" times each step (see instruments.py). It is None when we aren't timing anything.
+    # CHANGE_9: the UPDATE and INSERT are named statements (see statements.py), run on the same two
+    # cursors every time, and found already prepared in the connection's statement cache
+    def _save(self, amount, key: str, probe) -> bool:
+        deposit_time = Account._current_time(self.name, self._pool.schema["time_format"])
+        keys = self._pool.schema["keys"]
+        if probe is not None:
+            mark = probe.clock()
+
+        # CHANGE_2: code for rolling back if error is found.
+        with self._pool.writing() as db:
+            balances = self._pool.balances
+            statements = self._pool.statements  # CHANGE_9
+            try:   # CHANGE_2
+                zone = self._pool.schema["zones"].intern(db)
+                if key is not None:
+                    keys.prune(db)
+                db.execute("BEGIN IMMEDIATE")
+                if probe is not None:
+                    mark = probe.lap("save_update.lock", mark)
+                balances.validate(db)
+                self._balance = balances.require(db, self.name)
+                if key is not None:
+                    done = keys.lookup(db, key)
+                    if done is not None:
+                        db.rollback()
+                        if probe is not None:
+                            probe.count("save_update.duplicate")
+                        return done  # a retry of an operation we already have
+                new_balance = self._balance + amount
+                if new_balance < 0:
+                    if probe is not None:
+                        probe.count("save_update.refused")
+                    if key is None:
+                        db.rollback()
+                        return False
+                    keys.save(db, key, False)  # remember that it was refused
+                    db.commit()
+                    return False
+                if probe is not None:
+                    mark = probe.clock()
+                statements.execute("update_balance", (new_balance, self.name))
+                if probe is not None:
+                    mark = probe.lap("save_update.update", mark)
+                statements.execute("insert_history", (deposit_time, self.name, amount, zone))
+                self._pool.schema["snapshots"].record(db, self.name, deposit_time, new_balance)
+                if key is not None:
+                    keys.save(db, key, True)
+                if probe is not None:
+                    mark = probe.lap("save_update.insert", mark)
+            except sqlite3.Error as error:
+                if probe is not None:
+                    probe.count("save_update.integrity_error" if isinstance(error, sqlite3.IntegrityError)
+                                else "save_update.error")
+                    mark = probe.clock()
+                db.rollback()  # Rollback if you get an error
+                self._pool.schema["snapshots"].forget([self.name])
+                if probe is not None:
+                    probe.lap("save_update.rollback", mark)
+                return False
+            except BaseException:
+                db.rollback()  # not a database error: undo, and let it go on up
+                self._pool.schema["snapshots"].forget([self.name])
+                raise
+            else:
+                db.commit()  # Commits if no error is found
+                if probe is not None:
+                    probe.lap("save_update.commit", mark)
+                self._balance = new_balance  # Then updates the balance
+                balances.put(self.name, new_balance)  # and the cache
+                return True
+
+    def deposit(self, amount: int, key: str = None) -> float:
+        probe = self._pool.probe
+        if probe is not None:
+            started = probe.clock()
         if amount > 0.0:
             # new_balance = self._balance + amount
             # deposit_time = Account._current_time()
@@ -80,27 +344,42 @@ class Account(object):
             # db.execute("INSERT INTO history VALUES(?, ?, ?)", (deposit_time, self.name, amount))
             # db.commit()
             # self._balance = new_balance
-            self._save_update(amount)
-            print("{:.2f} deposited".format(amount / 100))
+            self._save_update(amount, key)
+            _events(self._pool).emit("deposited", self.name, amount, self._balance)
+        if probe is not None:
+            probe.lap("account.deposit", started)
         return self._balance / 100
 
-    def withdraw(self, amount: int) -> float:
-        if 0 < amount <= self._balance:
+    # With a key, a retry must get the first result even if the balance has gone down since,
+    # so _save_update does the balance check
+    def withdraw(self, amount: int, key: str = None) -> float:
+        probe = self._pool.probe
+        if probe is None:
+            return self._withdraw(amount, key)
+        started = probe.clock()
+        try:
+            return self._withdraw(amount, key)
+        finally:
+            probe.lap("account.withdraw", started)
+
+    def _withdraw(self, amount: int, key: str = None) -> float:
+        if 0 < amount and (key is not None or amount <= self._balance):
             # new_balance = self._balance - amount
             # withdrawal_time = Account._current_time()
             # db.execute("UPDATE accounts SET balance = ? WHERE (name = ?)", (new_balance, self.name))
             # db.execute("INSERT INTO history VALUES(?, ?, ?)", (withdrawal_time, self.name, -amount))
             # db.commit()
             # self._balance = new_balance
-            self._save_update(-amount)
-            print("{:.2f} withdrawn".format(amount / 100))
-            return amount / 100
-        else:
-            print("The amount must be greater than zero and no more than your account balance")
-            return 0.0
+            if self._save_update(-amount, key):
+                _events(self._pool).emit("withdrawn", self.name, amount, self._balance)
+                return amount / 100
+
+        # We also get here when _save_update finds that another process has already spent the money
+        _events(self._pool).emit("refused", self.name, amount, self._balance)
+        return 0.0
 
     def show_balance(self):
-        print("Balance on account {} is {:.2f}".format(self.name, self._balance / 100))
+        _events(self._pool).emit("balance", self.name, None, self._balance)
 
 if __name__ == '__main__':
     john = Account("John")
@@ -111,12 +390,16 @@ if __name__ == '__main__':
     john.withdraw(0)
     john.show_balance()
 
-    terry = Account("TerryJ")
-    graham = Account("Graham", 9000)
-    eric = Account("Eric", 7000)
-    michael = Account("Michael")
-    terryG = Account("TerryG")
+    # terry = Account("TerryJ")
+    # graham = Account("Graham", 9000)
+    # eric = Account("Eric", 7000)
+    # michael = Account("Michael")
+    # terryG = Account("TerryG")
+    terry, graham, eric, michael, terryG = Account.load_many([("TerryJ", 0), ("Graham", 9000), ("Eric", 7000),
+                                                              ("Michael", 0), ("TerryG", 0)])
+    for account in (terry, graham, eric, michael, terryG):
+        account.show_balance()
 
-    db.close()
+    default_pool.close()
 
 
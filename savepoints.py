@@ -0,0 +1,73 @@
+
+# =======================================================
+# Nested transactions with SAVEPOINT
+# =======================================================
+
+# =============
+# savepoints.py
+# =============
+
+# db.rollback() throws away EVERYTHING since the last commit.
+# That's right for one deposit, but in a batch of 1000 operations one bad operation would lose the other 999.
+
+# SQLite lets us mark points inside a transaction and go back to them:
+#   SAVEPOINT name       - remember this point (starts a transaction if there isn't one)
+#   ROLLBACK TO name     - undo everything done since the savepoint, the transaction stays open
+#   RELEASE name         - forget the savepoint, keeping the changes (they are still only committed by COMMIT)
+# Savepoints can be nested, each "with savepoint(db):" inside another one just undoes its own part.
+
+#   with transaction(db):                      # BEGIN IMMEDIATE ... COMMIT (or ROLLBACK on an exception)
+#       for operation in operations:
+#           try:
+#               with savepoint(db):            # if this block raises, only this block is undone
+#                   db.execute("INSERT ...")
+#                   db.execute("UPDATE ...")
+#           except sqlite3.IntegrityError:
+#               pass                           # skip this operation, keep the others
+
+import itertools
+import sqlite3
+from contextlib import contextmanager
+
+_names = itertools.count()
+
+
+@contextmanager
+def savepoint(db: sqlite3.Connection, name: str = None):
+    name = name if name is not None else "sp_{}".format(next(_names))
+    db.execute("SAVEPOINT {}".format(name))
+    try:
+        yield db
+    except BaseException:
+        db.execute("ROLLBACK TO {}".format(name))  # undo our part...
+        db.execute("RELEASE {}".format(name))      # ...and close the savepoint, the outer transaction carries on
+        raise
+    db.execute("RELEASE {}".format(name))
+
+
+# The outermost level: commits if the block finishes, rolls everything back if it raises.
+# immediate=True takes the write lock straight away (see rollback7._save_update)
+@contextmanager
+def transaction(db: sqlite3.Connection, immediate: bool = True):
+    db.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+    try:
+        yield db
+    except BaseException:
+        db.rollback()
+        raise
+    db.commit()
+
+
+if __name__ == '__main__':
+    db = sqlite3.connect(":memory:")
+    db.execute("CREATE TABLE history (time INTEGER NOT NULL, account TEXT NOT NULL, amount INTEGER NOT NULL,"
+               " PRIMARY KEY (time, account))")
+    with transaction(db):
+        for time, amount in [(1, 100), (2, 200), (1, 300), (3, 400)]:  # the 3rd one uses time 1 again
+            try:
+                with savepoint(db):
+                    db.execute("INSERT INTO history VALUES(?, 'John', ?)", (time, amount))
+            except sqlite3.IntegrityError:
+                print("Skipped {} at time {}".format(amount, time))
+    print(db.execute("SELECT * FROM history").fetchall())  # the other three are saved
+    db.close()
@@ -0,0 +1,307 @@
+
+# =======================================================
+# Sharded ledger over several SQLite files
+# =======================================================
+
+# ==================
+# shardedledger.py
+# ==================
+
+# SQLite only lets one connection write to a file at a time, so with a single accounts.sqlite
+# all our deposits and withdrawals queue up behind one write lock.
+
+# ShardedLedger splits the accounts over N files by a hash of the account name:
+#   accounts-0.sqlite, accounts-1.sqlite, ... accounts-{N-1}.sqlite
+# Each file is owned by its own worker process, which is the only one writing to it.
+# The router (ShardedLedger) sends each deposit/withdraw to the worker that owns the account,
+# so N shards can use N cores and N write locks at the same time.
+
+# Each worker saves whatever requests are waiting in one transaction with batchledger.apply_batch,
+# so the rollback rules are the same as everywhere else.
+
+#   with ShardedLedger(shards=4) as ledger:
+#       ledger.open("Graham", 9000)
+#       ledger.deposit("Graham", 100)       # waits for the commit
+#       future = ledger.submit("withdraw", "Graham", 50)   # doesn't wait
+#       ledger.transfer("Graham", "John", 25)   # atomic, even when they are on different shards
+
+# Transfers use transfers.py: one transaction when both accounts are on the same shard,
+# and the outbox (transfers_out / transfers_in) when they aren't. Any cross-shard transfer
+# left half done by a crash is finished when the ledger starts again.
+
+# Each worker's pool sends Account's messages ("Retrieved 0 accounts, created 1 accounts", ...) to the sink
+# made by ShardedLedger(events=...), see events.py. It is given as something that makes a sink (a sink class
+# like events.NullSink, or a module level function) because the sink itself would have to be pickled
+# to get to the worker process. With events=None the workers print them, like Account does.
+
+import itertools
+import multiprocessing
+import queue
+import threading
+import uuid
+import zlib
+from concurrent.futures import Future
+
+_STOP = None
+PENDING = "pending"  # the same as transfers.PENDING (transfers.py is only imported by the workers)
+
+
+# crc32 is the same in every process (unlike hash(), which changes from run to run)
+def shard_for(name: str, shards: int) -> int:
+    return zlib.crc32(name.encode("utf-8")) % shards
+
+
+def _worker(database: str, requests: multiprocessing.Queue, responses: multiprocessing.Queue, max_batch: int,
+            events=None):
+    # imported here so the router process doesn't need them
+    from batchledger import apply_batch
+    from connpool import ConnectionPool
+    from rollback7 import Account, create_schema
+    import transfers
+
+    pool = ConnectionPool(database, on_create=create_schema, events=events() if events is not None else None)
+    accounts = {}
+    stopping = False
+    while not stopping:
+        batch = [requests.get()]
+        while len(batch) < max_batch:
+            try:
+                batch.append(requests.get_nowait())
+            except queue.Empty:
+                break
+        if _STOP in batch:
+            stopping = True
+            batch = [request for request in batch if request is not _STOP]
+
+        # Every request gets its own result or error. An error in one step only fails the requests of that
+        # step, never requests that another step has already committed (the caller might retry those).
+        try:
+            # open any accounts we haven't seen yet, all at once
+            new = {}
+            for _, operation, name, amount, other in batch:
+                if operation == "open":
+                    new[name] = amount
+                elif name is not None:
+                    new.setdefault(name, 0)
+                if operation == "transfer":
+                    new.setdefault(other, 0)
+            new = {name: amount for name, amount in new.items() if name not in accounts}
+            if new:
+                for account in Account.load_many(new.items(), pool):
+                    accounts[account.name] = account
+        except Exception as error:  # nothing has been committed for this batch
+            for request_id, *_ in batch:
+                responses.put((request_id, None, repr(error)))
+            continue
+
+        updates = [request for request in batch if request[1] in ("deposit", "withdraw")]
+        local = [request for request in batch if request[1] == "transfer"]
+        try:
+            saved = apply_batch(pool, [(accounts[name], amount if operation == "deposit" else -amount,
+                                        Account._current_time(name, pool.schema["time_format"]))
+                                       for _, operation, name, amount, _ in updates]) if updates else []
+            for (request_id, _, name, _, _), result in zip(updates, saved):
+                responses.put((request_id, (result, accounts[name]._balance), None))
+        except Exception as error:
+            for request_id, *_ in updates:
+                responses.put((request_id, None, repr(error)))
+        try:
+            saved = transfers.transfer_many([(accounts[name], accounts[other], amount)
+                                             for _, _, name, amount, other in local]) if local else []
+            for (request_id, _, name, _, _), result in zip(local, saved):
+                responses.put((request_id, (result, accounts[name]._balance), None))
+        except Exception as error:
+            for request_id, *_ in local:
+                responses.put((request_id, None, repr(error)))
+
+        for request_id, operation, name, amount, other in batch:
+            try:
+                if operation in ("open", "balance"):
+                    result = accounts[name]._balance
+                elif operation == "transfer_out":
+                    to_account, to_database, transfer_id = other
+                    result = transfers.send_transfer(accounts[name], to_account, to_database, amount, transfer_id)
+                elif operation == "transfer_in":
+                    result = transfers.receive_transfer(accounts[name], other, amount)
+                elif operation == "transfer_done":
+                    transfers.finish_transfer(pool, other)
+                    result = True
+                elif operation == "pending":
+                    result = transfers.pending_transfers(pool)
+                else:
+                    continue  # answered above
+            except Exception as error:
+                responses.put((request_id, None, repr(error)))
+            else:
+                responses.put((request_id, result, None))
+    pool.close()
+
+
+# True if the request's result is true, False if it is false or the worker sent an error
+def _succeeded(future: Future) -> bool:
+    try:
+        return bool(future.result())
+    except RuntimeError:
+        return False
+
+
+class ShardedLedger(object):
+
+    def __init__(self, shards: int = None, database: str = "accounts-{}.sqlite", max_batch: int = 1000,
+                 events=None):
+        self.shards = shards if shards is not None else multiprocessing.cpu_count()
+        self.databases = [database.format(shard) for shard in range(self.shards)]
+        self._ids = itertools.count()
+        self._futures = {}
+        self._lock = threading.Lock()
+        self._responses = multiprocessing.Queue()
+        self._requests = []
+        self._workers = []
+        for path in self.databases:
+            requests = multiprocessing.Queue()
+            worker = multiprocessing.Process(target=_worker,
+                                             args=(path, requests, self._responses, max_batch, events), daemon=True)
+            worker.start()
+            self._requests.append(requests)
+            self._workers.append(worker)
+        self._reader = threading.Thread(target=self._read_responses, name="shard-responses", daemon=True)
+        self._reader.start()
+        self.recover_transfers()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def database_for(self, name: str) -> str:
+        return self.databases[shard_for(name, self.shards)]
+
+    # Sends one request to the account's shard. The future's result is:
+    #   open, balance      -> the balance
+    #   deposit, withdraw  -> (True if it was saved, the balance afterwards)
+    def submit(self, operation: str, name: str, amount: int = 0) -> Future:
+        if operation not in ("open", "balance", "deposit", "withdraw"):
+            raise ValueError("Unknown operation {!r}".format(operation))
+        if operation in ("deposit", "withdraw") and amount <= 0:
+            future = Future()
+            future.set_result((False, None))
+            return future
+        return self._send(shard_for(name, self.shards), operation, name, amount)
+
+    def _send(self, shard: int, operation: str, name, amount: int = 0, other=None) -> Future:
+        future = Future()
+        with self._lock:
+            request_id = next(self._ids)
+            self._futures[request_id] = future
+        self._requests[shard].put((request_id, operation, name, amount, other))
+        return future
+
+    def open(self, name: str, opening_balance: int = 0) -> int:
+        return self.submit("open", name, opening_balance).result()
+
+    def balance(self, name: str) -> int:
+        return self.submit("balance", name).result()
+
+    def deposit(self, name: str, amount: int) -> bool:
+        return self.submit("deposit", name, amount).result()[0]
+
+    def withdraw(self, name: str, amount: int) -> bool:
+        return self.submit("withdraw", name, amount).result()[0]
+
+    def transfer(self, src: str, dst: str, amount: int) -> bool:
+        return self.transfer_many([(src, dst, amount)])[0]
+
+    # Transfers between two accounts of the same shard are one transaction in that shard's worker.
+    # Between shards they go through the outbox in transfers.py: debit on the source shard,
+    # then credit on the destination shard, then mark the transfer done on the source shard.
+    # Each step is sent for all the transfers before waiting, so the workers can batch them.
+    # Returns True, False or transfers.PENDING for each transfer: PENDING means the source was debited
+    # but the credit failed twice. It stays in the outbox and recover_transfers() finishes it.
+    def transfer_many(self, transfers: list) -> list:
+        results = [False] * len(transfers)
+        local = []
+        sent = []
+        for position, (src, dst, amount) in enumerate(transfers):
+            if amount <= 0 or src == dst:
+                continue
+            shard = shard_for(src, self.shards)
+            if shard == shard_for(dst, self.shards):
+                local.append((position, self._send(shard, "transfer", src, amount, dst)))
+            else:
+                transfer_id = uuid.uuid4().hex
+                sent.append((position, src, dst, amount, transfer_id,
+                             self._send(shard, "transfer_out", src, amount,
+                                        (dst, self.database_for(dst), transfer_id))))
+        for position, future in local:
+            results[position] = future.result()[0]
+
+        debited = [(position, src, dst, amount, transfer_id)
+                   for position, src, dst, amount, transfer_id, future in sent if future.result() is not None]
+        done = []
+        for attempt in range(2):  # receive_transfer ignores a transfer it already has, so trying again is safe
+            received = [(transfer, self._send(shard_for(transfer[2], self.shards), "transfer_in", transfer[2],
+                                              transfer[3], transfer[4])) for transfer in debited]
+            debited = []
+            for transfer, future in received:
+                position, src, _, _, transfer_id = transfer
+                if _succeeded(future):
+                    done.append(self._send(shard_for(src, self.shards), "transfer_done", src, 0, transfer_id))
+                    results[position] = True
+                else:
+                    debited.append(transfer)
+        for position, *_ in debited:
+            results[position] = PENDING
+        for future in done:
+            _succeeded(future)  # if it failed the transfer is still in the outbox, recover_transfers() marks it done
+        return results
+
+    # Finishes cross-shard transfers that were interrupted (the program stopped between the steps).
+    # Returns how many were finished.
+    def recover_transfers(self) -> int:
+        pending = [(shard, self._send(shard, "pending", None)) for shard in range(self.shards)]
+        recovered = 0
+        for shard, future in pending:
+            for transfer_id, src, _, dst, amount in future.result():
+                if _succeeded(self._send(shard_for(dst, self.shards), "transfer_in", dst, amount, transfer_id)):
+                    _succeeded(self._send(shard, "transfer_done", src, 0, transfer_id))
+                    recovered += 1
+        return recovered
+
+    def _read_responses(self):
+        while True:
+            response = self._responses.get()
+            if response is _STOP:
+                return
+            request_id, result, error = response
+            with self._lock:
+                future = self._futures.pop(request_id)
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(RuntimeError(error))
+
+    # Lets the workers finish what they have been sent, then stops them
+    def close(self):
+        for requests in self._requests:
+            requests.put(_STOP)
+        for worker in self._workers:
+            worker.join()
+        self._responses.put(_STOP)
+        self._reader.join()
+
+
+if __name__ == '__main__':
+    from events import NullSink
+
+    with ShardedLedger(shards=4, events=NullSink) as ledger:
+        names = ["John", "TerryJ", "Graham", "Eric", "Michael", "TerryG"]
+        for name in names:
+            ledger.open(name, 9000)
+        futures = [ledger.submit("deposit", name, 10) for name in names for _ in range(100)]
+        print("{} of {} deposits saved".format(sum(future.result()[0] for future in futures), len(futures)))
+        for name in names:
+            print("Balance on account {} ({}) is {:.2f}".format(name, ledger.database_for(name),
+                                                                ledger.balance(name) / 100))
+        print(ledger.transfer_many([("John", "Graham", 500), ("Eric", "TerryG", 250), ("Michael", "John", 10 ** 9)]))
+        print("Total of all balances: {:.2f}".format(sum(ledger.balance(name) for name in names) / 100))
@@ -0,0 +1,119 @@
+
+# =======================================================
+# Balance snapshots
+# =======================================================
+
+# ==============
+# snapshots.py
+# ==============
+
+# The accounts table only has the current balance. To find "what was John's balance at time T"
+# we would have to add up history.amount from the very beginning.
+
+# The snapshots table keeps checkpoints of each account's balance:
+#   snapshots (account, time, balance)   balance is the balance just after the operation at "time"
+# A checkpoint is saved when an account is created, then by _save_update / apply_batch
+# every "every" operations on the account, and for the first operation of each (UTC) day.
+# It is saved in the same transaction as the history row, so it always agrees with history.
+# Operation times are taken before the write lock, so an operation can be applied after one with a later time.
+# Its balance then includes that later operation, so no checkpoint is saved for it, and the account's
+# checkpoints after its time (which left it out) are deleted; balance_at adds up history from an earlier one.
+
+# balance_at(pool, "John", T) is then one checkpoint lookup plus the sum of the few history rows after it.
+
+import datetime
+import sqlite3
+
+from connpool import ConnectionPool
+from monoclock import parse_timestamp, storage_time, to_us
+
+_DAY_US = 86400 * 1000000
+
+
+# Microseconds since 1970, from either time format
+def _us(moment) -> int:
+    if isinstance(moment, str):
+        moment = parse_timestamp(moment)
+    if isinstance(moment, datetime.datetime):
+        moment = to_us(moment)
+    return moment
+
+
+def _day(moment) -> int:
+    return _us(moment) // _DAY_US
+
+
+class Snapshots(object):
+
+    def __init__(self, every: int = 1000, daily: bool = True):
+        self.every = every
+        self.daily = daily
+        # account name -> [operations since the last checkpoint, day of the last checkpoint, latest operation (us)]
+        self._state = {}
+
+    # Call inside the transaction, after the account's history row has been inserted.
+    # _state moves on straight away, so if the transaction (or a savepoint around the call) is rolled back,
+    # call forget() for its accounts: their counts and days are then read again from the database.
+    def record(self, db: sqlite3.Connection, name: str, op_time, balance: int):
+        state = self._state.get(name)
+        if state is None:
+            state = self._state[name] = self._load(db, name, op_time)
+        state[0] += 1
+        moment = _us(op_time)
+        if state[2] is not None and moment < state[2]:
+            db.execute("DELETE FROM snapshots WHERE (account = ?) AND (time > ?)", (name, op_time))
+            return
+        state[2] = moment
+        day = _day(op_time)
+        if state[0] >= self.every or (self.daily and day != state[1]):
+            db.execute("INSERT OR REPLACE INTO snapshots VALUES(?, ?, ?)", (name, op_time, balance))
+            state[0] = 0
+            state[1] = day
+
+    # The first checkpoints, with the opening balances, for a list of new (name, time, balance)
+    def opened(self, db: sqlite3.Connection, accounts: list):
+        db.executemany("INSERT OR REPLACE INTO snapshots VALUES(?, ?, ?)", accounts)
+        for name, op_time, _ in accounts:
+            self._state[name] = [0, _day(op_time), _us(op_time)]
+
+    # Works out where we are for an account we haven't seen since the program started (or since forget()),
+    # counting the operations before op_time (the one being recorded may or may not be in history already)
+    # and finding the latest one that is not op_time itself
+    @staticmethod
+    def _load(db: sqlite3.Connection, name: str, op_time) -> list:
+        latest = db.execute("SELECT MAX(time) FROM history WHERE (account = ?) AND (time <> ?)",
+                            (name, op_time)).fetchone()[0]
+        latest = None if latest is None else _us(latest)
+        row = db.execute("SELECT time FROM snapshots WHERE (account = ?) ORDER BY time DESC LIMIT 1",
+                         (name,)).fetchone()
+        if row is None:
+            return [0, None, latest]  # no checkpoint yet, so the next operation makes one
+        count = db.execute("SELECT COUNT(*) FROM history WHERE (account = ?) AND (time > ?) AND (time < ?)",
+                           (name, row[0], op_time)).fetchone()[0]
+        return [count, _day(row[0]), latest]
+
+    # After a rollback: what we remember about these accounts may include operations that were undone
+    def forget(self, names):
+        for name in names:
+            self._state.pop(name, None)
+
+    def clear(self):
+        self._state.clear()
+
+
+# The balance of an account just after time "moment" (an aware datetime, or microseconds since 1970)
+def balance_at(pool: ConnectionPool, name: str, moment) -> int:
+    db = pool.reader()
+    moment = storage_time(moment, pool.schema["time_format"])
+    row = db.execute("SELECT time, balance FROM snapshots WHERE (account = ?) AND (time <= ?)"
+                     " ORDER BY time DESC LIMIT 1", (name, moment)).fetchone()
+    if row is None:
+        # No checkpoint that early (an account from before snapshots existed): add up everything
+        balance = 0
+        tail = db.execute("SELECT COALESCE(SUM(amount), 0) FROM history WHERE (account = ?) AND (time <= ?)",
+                          (name, moment))
+    else:
+        since, balance = row
+        tail = db.execute("SELECT COALESCE(SUM(amount), 0) FROM history"
+                          " WHERE (account = ?) AND (time > ?) AND (time <= ?)", (name, since, moment))
+    return balance + tail.fetchone()[0]
@@ -0,0 +1,58 @@
+
+# =======================================================
+# Named SQL statements and reused cursors
+# =======================================================
+
+# ===============
+# statements.py
+# ===============
+
+# sqlite3 keeps the statements it has prepared (parsed and compiled) in a cache on each connection, keyed
+# by the SQL text. A statement found in the cache is not parsed again. The cache holds "cached_statements"
+# statements (an argument of sqlite3.connect, ConnectionPool passes its own cached_statements to it).
+# db.execute(sql) also makes a new cursor object every time.
+
+# STATEMENTS gives each SQL statement that is run for every operation a name, so the same text
+# (and so the same prepared statement) is always used, and the statements can be listed in one place.
+# rollback7.py, batchledger.py, transfers.py, vectorledger.py and balancecache.py all take them from here.
+
+# Statements(connection) runs them by name, with one cursor per name that is reused every time:
+#   statements = pool.statements          # the writer's Statements, use inside "with pool.writing() as db:"
+#   statements.execute("update_balance", (new_balance, name))
+#   statements.executemany("insert_history", rows)
+# A cursor is reused by the next call with the same name, so read the rows of a SELECT before running it again.
+
+import sqlite3
+
+STATEMENTS = {
+    "select_balance": "SELECT balance FROM accounts WHERE (name = ?)",
+    "insert_account": "INSERT INTO accounts VALUES(?, ?)",
+    "update_balance": "UPDATE accounts SET balance = ? WHERE (name = ?)",
+    "insert_history": "INSERT INTO history (time, account, amount, zone) VALUES(?, ?, ?, ?)",
+}
+
+
+class Statements(object):
+
+    def __init__(self, connection: sqlite3.Connection):
+        self.connection = connection
+        self._cursors = {}  # statement name -> cursor
+
+    def cursor(self, name: str) -> sqlite3.Cursor:
+        cursor = self._cursors.get(name)
+        if cursor is None:
+            if name not in STATEMENTS:
+                raise KeyError("Unknown statement {!r}".format(name))
+            cursor = self._cursors[name] = self.connection.cursor()
+        return cursor
+
+    def execute(self, name: str, parameters=()) -> sqlite3.Cursor:
+        return self.cursor(name).execute(STATEMENTS[name], parameters)
+
+    def executemany(self, name: str, seq_of_parameters) -> sqlite3.Cursor:
+        return self.cursor(name).executemany(STATEMENTS[name], seq_of_parameters)
+
+    def close(self):
+        for cursor in self._cursors.values():
+            cursor.close()
+        self._cursors = {}
@@ -0,0 +1,55 @@
+
+# =======================================================
+# Tests: apply_batch and its savepoint fallback
+# =======================================================
+
+# ====================
+# test_batchledger.py
+# ====================
+
+# Run with: python -m pytest -q
+# When the fast executemany fails with an IntegrityError, apply_batch goes back to its savepoint and saves
+# the operations one at a time: only the failing one is lost (see batchledger._apply).
+
+import pytest
+
+from batchledger import apply_batch
+from connpool import ConnectionPool
+from events import NullSink
+from reconcile import reconcile_range
+from rollback7 import Account, create_schema
+
+
+@pytest.fixture
+def pool(tmp_path):
+    pool = ConnectionPool(str(tmp_path / "accounts.sqlite"), on_create=create_schema, events=NullSink())
+    yield pool
+    pool.close()
+
+
+def test_duplicate_time_only_loses_that_operation(pool):
+    john = Account("John", 0, pool)
+    first = Account._current_time("John", pool.schema["time_format"])
+    second = Account._current_time("John", pool.schema["time_format"])
+    results = apply_batch(pool, [(john, 100, first), (john, 200, second), (john, 300, first), (john, -250, second)],
+                          ["a", "b", "c", "d"])
+
+    # 300 uses the time of the first deposit again, and -250 the time of the second one
+    assert results == [True, True, False, False]
+    assert john._balance == 300
+    assert pool.balances.load(pool.writer, "John") == 300
+    applied = dict(pool.writer.execute("SELECT key, applied FROM operation_keys"))
+    assert applied == {"a": 1, "b": 1}  # the lost operations can be retried with the same keys
+    assert reconcile_range(pool.database)[1] == []
+
+
+def test_fallback_keeps_the_overdraft_check(pool):
+    john = Account("John", 0, pool)
+    first = Account._current_time("John", pool.schema["time_format"])
+    second = Account._current_time("John", pool.schema["time_format"])
+    # the 50 is lost, so the withdrawal would now overdraw the account
+    results = apply_batch(pool, [(john, 500, first), (john, 50, first), (john, -550, second)])
+
+    assert results == [True, False, False]
+    assert john._balance == 500
+    assert reconcile_range(pool.database)[1] == []
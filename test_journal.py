@@ -0,0 +1,64 @@
+
+# =======================================================
+# Tests: replaying the operation journal
+# =======================================================
+
+# ================
+# test_journal.py
+# ================
+
+# Run with: python -m pytest -q
+# After a crash the same journal lines can be replayed again (the process may die before the journal
+# is emptied). The operation keys make the second replay change nothing (see journal.py).
+
+import pytest
+
+from connpool import ConnectionPool
+from events import NullSink
+from journal import OpJournal, _entry
+from rollback7 import Account, create_schema
+
+
+@pytest.fixture
+def pool(tmp_path):
+    pool = ConnectionPool(str(tmp_path / "accounts.sqlite"), on_create=create_schema, events=NullSink())
+    yield pool
+    pool.close()
+
+
+def _write_journal(path: str, lines: list):
+    with open(path, "w", encoding="utf-8") as journal:
+        journal.write("".join(line + "\n" for line in lines))
+
+
+def test_replay_twice_applies_once(pool, tmp_path):
+    path = str(tmp_path / "accounts.journal")
+    john = Account("John", 0, pool)
+    time_format = pool.schema["time_format"]
+    lines = [_entry(john, amount, Account._current_time("John", time_format), key)
+             for amount, key in [(1000, "k1"), (-300, "k2"), (-5000, "k3")]]
+
+    for _ in range(2):
+        _write_journal(path, lines)
+        journal = OpJournal(path, pool)
+        journal.close()
+        assert journal.replayed == 3
+        assert journal.outcome("k1") is True
+        assert journal.outcome("k3") is False  # refused, and still refused the second time
+
+    assert pool.balances.load(pool.writer, "John") == 700
+    assert pool.writer.execute("SELECT COUNT(*) FROM history WHERE (account = 'John')").fetchone()[0] == 2
+    with open(path, encoding="utf-8") as journal:
+        assert journal.read() == ""  # emptied after the replay
+
+
+def test_torn_last_line_is_ignored(pool, tmp_path):
+    path = str(tmp_path / "accounts.journal")
+    john = Account("John", 0, pool)
+    line = _entry(john, 250, Account._current_time("John", pool.schema["time_format"]), "k1")
+    _write_journal(path, [line, line[:len(line) // 2]])
+
+    journal = OpJournal(path, pool)
+    journal.close()
+    assert journal.replayed == 1
+    assert pool.balances.load(pool.writer, "John") == 250
@@ -0,0 +1,42 @@
+
+# =======================================================
+# Tests: the history queries use the indexes
+# =======================================================
+
+# ===================
+# test_queryplans.py
+# ===================
+
+# Run with: python -m pytest -q
+# Builds an empty database with create_schema, for both time formats, and checks the plans (see queryplans.py).
+
+import sqlite3
+
+import pytest
+
+from monoclock import EPOCH_US, TIMESTAMP
+from queryplans import QUERIES, check_query_plans
+from rollback7 import create_schema
+
+
+@pytest.mark.parametrize("time_format", [TIMESTAMP, EPOCH_US])
+def test_history_queries_use_indexes(tmp_path, time_format):
+    db = sqlite3.connect(str(tmp_path / "accounts.sqlite"))
+    try:
+        create_schema(db, time_format)
+        db.commit()
+        plans = check_query_plans(db)
+    finally:
+        db.close()
+    assert set(plans) == set(QUERIES)
+
+
+def test_missing_index_is_reported(tmp_path):
+    db = sqlite3.connect(str(tmp_path / "accounts.sqlite"))
+    try:
+        create_schema(db)
+        db.execute("DROP INDEX history_account_time")
+        with pytest.raises(AssertionError):
+            check_query_plans(db)
+    finally:
+        db.close()
@@ -0,0 +1,48 @@
+
+# =======================================================
+# Tests: the NumPy postings check against the Python loop
+# =======================================================
+
+# =====================
+# test_vectorledger.py
+# =====================
+
+# Run with: python -m pytest -q
+# check_postings must accept and refuse exactly the rows _check_python does, with the same balances.
+
+import random
+
+import pytest
+
+import vectorledger
+from vectorledger import _check_python, check_postings
+
+
+def _compare(indices: list, amounts: list, start: dict):
+    accepted, after = check_postings(indices, amounts, start)
+    expected_accepted, expected_after = _check_python(indices, amounts, start)
+    assert [bool(ok) for ok in accepted] == expected_accepted
+    assert [int(balance) for balance in after] == expected_after
+
+
+@pytest.mark.skipif(vectorledger.numpy is None, reason="NumPy is not installed")
+@pytest.mark.parametrize("seed", range(20))
+def test_random_postings_match_python(seed):
+    generator = random.Random(seed)
+    accounts = generator.randint(1, 30)
+    rows = generator.randint(0, 2000)
+    start = {index: generator.randint(0, 5000) for index in range(accounts)}
+    indices = [generator.randrange(accounts) for _ in range(rows)]
+    amounts = [generator.choice([0, generator.randint(-3000, 3000)]) for _ in range(rows)]
+    _compare(indices, amounts, start)
+
+
+@pytest.mark.skipif(vectorledger.numpy is None, reason="NumPy is not installed")
+def test_refused_withdrawal_then_smaller_one():
+    # the 700 is refused, but the 400 after it still fits
+    _compare([0, 1, 0, 0, 1], [-700, 50, -400, 0, -60], {0: 500, 1: 10})
+
+
+def test_no_rows():
+    accepted, after = check_postings([], [], {})
+    assert len(accepted) == 0 and len(after) == 0
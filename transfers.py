@@ -0,0 +1,225 @@
+
+# =======================================================
+# Transfers between accounts
+# =======================================================
+
+# ==============
+# transfers.py
+# ==============
+
+# This is the bank transfer example from the start of rollback.py: we never want one account debited
+# without the other one being credited.
+# Doing it as a withdraw() and a deposit() is two separate commits, and a crash between them loses the money.
+
+# transfer(src, dst, amount) and transfer_many([(src, dst, amount), ...]) put both history rows and both
+# balance updates in ONE transaction, so either both happen or neither does.
+
+# Lock order: when transfers touch several pools, the pools' writers are always locked in the same order
+# (sorted by database file name), so two threads doing A -> B and B -> A can't deadlock.
+# Inside a pool, BEGIN IMMEDIATE takes the file's write lock before we read any balances, so two connections
+# can't both read and then wait for each other to be able to write.
+
+# Accounts in two DIFFERENT database files (two pools, or two shards of shardedledger.py) can't share
+# a transaction (SQLite doesn't make ATTACHed WAL databases atomic together), so those use an "outbox":
+#   1. send_transfer:    debit the source account AND save the transfer in transfers_out (one transaction)
+#   2. receive_transfer: credit the destination AND save the transfer id in transfers_in (one transaction).
+#                        If the id is already there the transfer was already applied, so it is never applied twice
+#   3. finish_transfer:  mark the transfer done in transfers_out
+# If we crash part way, recover_transfers() finds the transfers that aren't done and runs steps 2 and 3 again.
+# If step 2 fails (the destination file is locked, full, ...) the transfer stays in transfers_out with done = 0,
+# and transfer_many reports it as PENDING: the source has been debited, and recover_transfers() will credit
+# the destination later. PENDING is true, like True, because the money is on its way and can't be lost.
+
+import sqlite3
+import uuid
+
+from connpool import ConnectionPool
+from rollback7 import Account
+from savepoints import savepoint
+
+PENDING = "pending"  # a transfer_many result: debited, credit not done yet (see above)
+
+
+# Adds one history row and updates the balance in "balances"
+def _post(pool: ConnectionPool, db: sqlite3.Connection, name: str, amount: int, zone: int, balances: dict):
+    op_time = Account._current_time(name, pool.schema["time_format"])
+    pool.statements.execute("insert_history", (op_time, name, amount, zone))
+    balances[name] += amount
+    pool.schema["snapshots"].record(db, name, op_time, balances[name])
+
+
+def _load(pool: ConnectionPool, db: sqlite3.Connection, balances: dict, name: str) -> int:
+    if name not in balances:
+        balances[name] = pool.balances.require(db, name)
+    return balances[name]
+
+
+# Saves the new balances, commits, and only then updates the Account objects and the balance cache
+def _commit(pool: ConnectionPool, db: sqlite3.Connection, balances: dict, accounts: list):
+    pool.statements.executemany("update_balance", [(balance, name) for name, balance in balances.items()])
+    db.commit()
+    for name, balance in balances.items():
+        pool.balances.put(name, balance)
+    for account in accounts:
+        account._balance = balances[account.name]
+
+
+# All the transfers must be between accounts of the same pool
+def _transfer_in_pool(pool: ConnectionPool, transfers: list) -> list:
+    with pool.writing() as db:
+        zone = pool.schema["zones"].intern(db)
+        balances = {}
+        results = []
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            pool.balances.validate(db)
+            for src, dst, amount in transfers:
+                if amount <= 0 or src.name == dst.name or _load(pool, db, balances, src.name) < amount:
+                    results.append(False)
+                    continue
+                _load(pool, db, balances, dst.name)
+                before = dict(balances)
+                try:
+                    with savepoint(db):  # if either row can't be added, only this transfer is undone
+                        _post(pool, db, src.name, -amount, zone, balances)
+                        _post(pool, db, dst.name, amount, zone, balances)
+                except sqlite3.IntegrityError:
+                    balances.update(before)
+                    pool.schema["snapshots"].forget([src.name, dst.name])
+                    results.append(False)
+                    continue
+                results.append(True)
+            _commit(pool, db, balances, [account for src, dst, _ in transfers for account in (src, dst)])
+        except sqlite3.Error:
+            db.rollback()
+            pool.schema["snapshots"].forget(balances)
+            return [False] * len(transfers)
+        except BaseException:
+            db.rollback()  # not a database error: undo, and let it go on up
+            pool.schema["snapshots"].forget(balances)
+            raise
+        return results
+
+
+def transfer(src: Account, dst: Account, amount: int):
+    return transfer_many([(src, dst, amount)])[0]
+
+
+# Returns True, False (nothing was done) or PENDING for each transfer
+def transfer_many(transfers: list) -> list:
+    results = [False] * len(transfers)
+    same_pool = {}  # pool -> [(position, transfer)]
+    other = []
+    for position, (src, dst, amount) in enumerate(transfers):
+        if src._pool is dst._pool:
+            same_pool.setdefault(src._pool, []).append((position, (src, dst, amount)))
+        else:
+            other.append((position, (src, dst, amount)))
+
+    for pool in sorted(same_pool, key=lambda pool: pool.database):  # always the same lock order
+        positions = [position for position, _ in same_pool[pool]]
+        for position, result in zip(positions, _transfer_in_pool(pool, [t for _, t in same_pool[pool]])):
+            results[position] = result
+
+    for position, (src, dst, amount) in other:
+        transfer_id = send_transfer(src, dst.name, dst._pool.database, amount)
+        if transfer_id is None:
+            continue
+        if receive_transfer(dst, transfer_id, amount):
+            finish_transfer(src._pool, transfer_id)
+            results[position] = True
+        else:
+            results[position] = PENDING  # done = 0, so recover_transfers() finishes it
+    return results
+
+
+# Step 1 of a transfer to another database file. Returns the transfer id, or None if it was refused.
+def send_transfer(src: Account, to_account: str, to_database: str, amount: int, transfer_id: str = None):
+    pool = src._pool
+    transfer_id = transfer_id if transfer_id is not None else uuid.uuid4().hex
+    with pool.writing() as db:
+        zone = pool.schema["zones"].intern(db)
+        balances = {}
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            pool.balances.validate(db)
+            if amount <= 0 or _load(pool, db, balances, src.name) < amount:
+                db.rollback()
+                return None
+            _post(pool, db, src.name, -amount, zone, balances)
+            db.execute("INSERT INTO transfers_out (id, account, to_database, to_account, amount) VALUES(?, ?, ?, ?, ?)",
+                       (transfer_id, src.name, to_database, to_account, amount))
+            _commit(pool, db, balances, [src])
+        except sqlite3.Error:
+            db.rollback()
+            pool.schema["snapshots"].forget([src.name])
+            return None
+        except BaseException:
+            db.rollback()
+            pool.schema["snapshots"].forget([src.name])
+            raise
+    return transfer_id
+
+
+# Step 2. Returns True when the transfer has been applied (now, or before).
+def receive_transfer(dst: Account, transfer_id: str, amount: int) -> bool:
+    pool = dst._pool
+    with pool.writing() as db:
+        zone = pool.schema["zones"].intern(db)
+        balances = {}
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            pool.balances.validate(db)
+            if db.execute("SELECT 1 FROM transfers_in WHERE (id = ?)", (transfer_id,)).fetchone():
+                db.rollback()
+                return True  # already applied
+            _load(pool, db, balances, dst.name)
+            _post(pool, db, dst.name, amount, zone, balances)
+            db.execute("INSERT INTO transfers_in VALUES(?)", (transfer_id,))
+            _commit(pool, db, balances, [dst])
+        except sqlite3.Error:
+            db.rollback()
+            pool.schema["snapshots"].forget([dst.name])
+            return False
+        except BaseException:
+            db.rollback()
+            pool.schema["snapshots"].forget([dst.name])
+            raise
+    return True
+
+
+# Step 3
+def finish_transfer(pool: ConnectionPool, transfer_id: str):
+    with pool.writing() as db:
+        try:
+            db.execute("UPDATE transfers_out SET done = 1 WHERE (id = ?)", (transfer_id,))
+        except BaseException:
+            db.rollback()  # don't leave the writer inside a transaction
+            raise
+        db.commit()
+
+
+# (id, account, to_database, to_account, amount) for every transfer that still needs steps 2 and 3
+def pending_transfers(pool: ConnectionPool) -> list:
+    with pool.writing() as db:
+        return db.execute("SELECT id, account, to_database, to_account, amount FROM transfers_out"
+                          " WHERE (done = 0)").fetchall()
+
+
+# Finishes the transfers that were interrupted. pools maps database file names to their ConnectionPool.
+def recover_transfers(pool: ConnectionPool, pools: dict) -> int:
+    recovered = 0
+    for transfer_id, _, to_database, to_account, amount in pending_transfers(pool):
+        dst = Account.load_many([(to_account, 0)], pools[to_database])[0]
+        if receive_transfer(dst, transfer_id, amount):
+            finish_transfer(pool, transfer_id)
+            recovered += 1
+    return recovered
+
+
+if __name__ == '__main__':
+    john, graham = Account.load_many([("John", 0), ("Graham", 9000)])
+    transfer(graham, john, 2500)
+    print(transfer_many([(graham, john, 100), (john, graham, 50), (john, graham, 10 ** 9)]))
+    john.show_balance()
+    graham.show_balance()
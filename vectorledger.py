@@ -0,0 +1,188 @@
+
+# =======================================================
+# Vectorized batch postings with NumPy
+# =======================================================
+
+# =================
+# vectorledger.py
+# =================
+
+# A day of payroll or fees is thousands of postings. Calling deposit()/withdraw() for each one runs
+# the "0 < amount <= self._balance" check, and everything else, once per row in Python.
+
+# apply_postings(table, indices, amounts) takes two arrays:
+#   indices  positions of the accounts in an AccountTable (see accounttable.py), repeats allowed
+#   amounts  integer cents, positive to deposit, negative to withdraw
+# and gives the same result as doing the rows one after the other, in order:
+#   - a withdrawal is rejected if the account's balance at that point is too small,
+#     and a rejected row doesn't change the balance for the rows after it
+#   - a row with amount 0 is rejected (deposit() and withdraw() refuse 0 too)
+# All the accepted rows are written to history and accounts in ONE transaction.
+# It returns a boolean array, True for each accepted row. numpy.flatnonzero(~accepted) are the rejected rows.
+
+# How the overdraft check is done with arrays:
+#   1. sort the rows by account, keeping their order inside each account (a "stable" sort)
+#   2. a cumulative sum over the sorted amounts, minus the sum at the start of each account's group,
+#      plus the account's balance, gives every account's running balance after each of its rows
+#   3. accounts whose running balance never goes below 0 are done: all their rows are accepted
+#   4. in the other accounts, everything before the FIRST row that goes below 0 is accepted, and from that row
+#      on we go through the rows one at a time (rejecting a row changes the balances of the rows after it)
+# So every row is looked at once by the arrays and at most once more by step 4: the time grows with the
+# number of rows, even when one account has thousands of withdrawals refused.
+
+# NumPy is optional: without it the same checks are done with a Python loop (slower, same result).
+
+import sqlite3
+
+try:
+    import numpy
+except ImportError:  # NumPy is optional, see above
+    numpy = None
+
+from accounttable import AccountTable
+from rollback7 import Account
+
+
+# The positions in the table of a list of names (the accounts must already be in the table)
+def positions(table: AccountTable, names: list):
+    found = [table._find(name) for name in names]
+    missing = [name for name, index in zip(names, found) if index < 0]
+    if missing:
+        raise KeyError(missing[0])
+    return numpy.array(found, dtype=numpy.int64) if numpy is not None else found
+
+
+# Works out which rows are accepted, starting from "start" (account position -> balance).
+# Returns (accepted, balance after each row): accepted[i] is True/False and after[i] is the account's
+# balance just after row i (only meaningful for accepted rows).
+def check_postings(indices, amounts, start: dict):
+    if numpy is None:
+        return _check_python(list(indices), list(amounts), start)
+    indices = numpy.asarray(indices, dtype=numpy.int64)
+    amounts = numpy.asarray(amounts, dtype=numpy.int64)
+    rows = len(indices)
+    if rows == 0:
+        return numpy.zeros(0, dtype=bool), numpy.zeros(0, dtype=numpy.int64)
+
+    order = numpy.argsort(indices, kind="stable")
+    sorted_indices = indices[order]
+    sorted_amounts = amounts[order]
+    first = numpy.ones(rows, dtype=bool)        # True on the first row of each account's group
+    first[1:] = sorted_indices[1:] != sorted_indices[:-1]
+    group = numpy.cumsum(first) - 1             # group number of each sorted row
+    starts = numpy.flatnonzero(first)           # sorted row where each group starts
+    opening = numpy.array([start[index] for index in sorted_indices[starts].tolist()], dtype=numpy.int64)
+
+    active = sorted_amounts != 0
+    effective = numpy.where(active, sorted_amounts, 0)
+    total = numpy.cumsum(effective)
+    before_group = total[starts] - effective[starts]  # cumulative sum just before each group
+    running = opening[group] + total - before_group[group]
+    overdrawn = numpy.flatnonzero(active & (running < 0))
+    if len(overdrawn):
+        # overdrawn is in sorted order, so the first row of each group in it is that account's first overdraft
+        _, first_in_group = numpy.unique(group[overdrawn], return_index=True)
+        ends = numpy.append(starts[1:], rows)  # sorted row just after each group
+        for first in overdrawn[first_in_group].tolist():
+            end = int(ends[group[first]])
+            balance = int(running[first] - effective[first])  # the balance just before the first overdraft
+            tail_active = active[first:end].tolist()
+            tail_running = []
+            for position, amount in enumerate(sorted_amounts[first:end].tolist()):
+                if tail_active[position] and balance + amount >= 0:
+                    balance += amount
+                else:
+                    tail_active[position] = False
+                tail_running.append(balance)
+            active[first:end] = tail_active
+            running[first:end] = tail_running
+
+    accepted = numpy.empty(rows, dtype=bool)
+    accepted[order] = active
+    after = numpy.empty(rows, dtype=numpy.int64)
+    after[order] = running
+    return accepted, after
+
+
+def _check_python(indices: list, amounts: list, start: dict):
+    balances = dict(start)
+    accepted = []
+    after = []
+    for index, amount in zip(indices, amounts):
+        ok = amount != 0 and balances[index] + amount >= 0
+        if ok:
+            balances[index] += amount
+        accepted.append(ok)
+        after.append(balances[index])
+    return accepted, after
+
+
+# Applies the postings to the database and the table. Like batchledger.apply_batch it takes the
+# write lock with BEGIN IMMEDIATE and starts from the balances in the database (through the pool's
+# BalanceCache), not from the table, which may be out of date.
+def apply_postings(table: AccountTable, indices, amounts):
+    if numpy is not None:
+        indices = numpy.asarray(indices, dtype=numpy.int64)
+        amounts = numpy.asarray(amounts, dtype=numpy.int64)
+    pool = table.pool
+    balance_cache = pool.balances
+    unique = sorted(set(indices.tolist() if numpy is not None else indices))
+    names = {index: table.name(index) for index in unique}
+    time_format = pool.schema["time_format"]
+    snapshots = pool.schema["snapshots"]
+
+    with pool.writing() as db:
+        zone = pool.schema["zones"].intern(db)
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            balance_cache.validate(db)
+            start = {index: balance_cache.require(db, names[index]) for index in unique}
+            accepted, after = check_postings(indices, amounts, start)
+
+            if numpy is not None:
+                rows = numpy.flatnonzero(accepted).tolist()
+                row_indices, row_amounts, row_after = indices.tolist(), amounts.tolist(), after.tolist()
+            else:
+                rows = [row for row, ok in enumerate(accepted) if ok]
+                row_indices, row_amounts, row_after = indices, amounts, after
+            history = []
+            final = dict(start)
+            for row in rows:  # in order, so each account's times go up with its rows
+                name = names[row_indices[row]]
+                op_time = Account._current_time(name, time_format)
+                history.append((op_time, name, row_amounts[row], zone))
+                snapshots.record(db, name, op_time, row_after[row])
+                final[row_indices[row]] = row_after[row]
+            pool.statements.executemany("insert_history", history)
+            pool.statements.executemany("update_balance", [(final[index], names[index])
+                                                           for index in unique if final[index] != start[index]])
+        except sqlite3.Error:
+            db.rollback()
+            snapshots.forget(names.values())
+            return numpy.zeros(len(indices), dtype=bool) if numpy is not None else [False] * len(indices)
+        except BaseException:
+            db.rollback()  # not a database error: undo, and let it go on up
+            snapshots.forget(names.values())
+            raise
+        db.commit()
+
+    # only after the commit, like rollback7._save_update
+    for index in unique:
+        balance_cache.put(names[index], final[index])
+        table._balances[index] = final[index]
+    return accepted
+
+
+if __name__ == '__main__':
+    import random
+
+    table = AccountTable()
+    table.open_many([("Payroll-{}".format(i), 1000) for i in range(1000)])
+    indices = positions(table, ["Payroll-{}".format(random.randrange(1000)) for _ in range(100000)])
+    amounts = [random.choice((-1, 1)) * random.randrange(1, 500) for _ in range(100000)]
+    if numpy is not None:
+        amounts = numpy.array(amounts, dtype=numpy.int64)
+
+    accepted = apply_postings(table, indices, amounts)
+    print("{} postings accepted, {} rejected".format(sum(accepted), len(accepted) - sum(accepted)))
+    print("Total of all balances: {:.2f}".format(sum(table.balances()) / 100))
@@ -0,0 +1,74 @@
+
+# =======================================================
+# Interned time zones
+# =======================================================
+
+# ==========
+# zones.py
+# ==========
+
+# In the timezone challenge (rollback6.py) every history row stores pickle.dumps(zone),
+# and checkdb.py calls pickle.loads on every row it reads.
+
+# Instead we keep each zone ONCE in a small "zones" table:
+#   zones (id INTEGER PRIMARY KEY, utcoffset INTEGER, name TEXT)   utcoffset is in seconds
+# and history.zone only holds the zone's id.
+# ZoneTable remembers the ids it has already looked up, so writers only touch the zones table the first time
+# they see a zone, and readers do one dictionary lookup per row.
+
+# Use migratedb.py to convert a rollback6.py file (pickled zones) to this format.
+
+import datetime
+import sqlite3
+import time
+
+
+# (utcoffset in seconds, zone name) for this machine's local time zone right now
+def local_zone_key() -> tuple:
+    now = time.localtime()
+    return now.tm_gmtoff, now.tm_zone
+
+
+def zone_key(zone: datetime.tzinfo) -> tuple:
+    return int(zone.utcoffset(None).total_seconds()), zone.tzname(None)
+
+
+class ZoneTable(object):
+
+    def __init__(self):
+        self._ids = {}    # (utcoffset, name) -> id
+        self._zones = {}  # id -> datetime.timezone
+
+    # Returns the id for the zone, adding it to the zones table the first time we see it.
+    # Call it OUTSIDE a transaction: a new zone is committed straight away, so a later rollback
+    # can't remove a zone whose id we have already remembered.
+    def intern(self, db: sqlite3.Connection, key: tuple = None) -> int:
+        if key is None:
+            key = local_zone_key()
+        zone_id = self._ids.get(key)
+        if zone_id is None:
+            db.execute("INSERT OR IGNORE INTO zones (utcoffset, name) VALUES(?, ?)", key)
+            db.commit()
+            zone_id = db.execute("SELECT id FROM zones WHERE (utcoffset = ?) AND (name = ?)", key).fetchone()[0]
+            self._ids[key] = zone_id
+        return zone_id
+
+    # Returns the tzinfo for a zone id (None if the row has no zone)
+    def resolve(self, db: sqlite3.Connection, zone_id: int):
+        if zone_id is None:
+            return None
+        zone = self._zones.get(zone_id)
+        if zone is None:
+            self.load(db)
+            zone = self._zones[zone_id]
+        return zone
+
+    # The zones table is tiny, so we just read all of it
+    def load(self, db: sqlite3.Connection):
+        for zone_id, utcoffset, name in db.execute("SELECT id, utcoffset, name FROM zones"):
+            self._ids[(utcoffset, name)] = zone_id
+            self._zones[zone_id] = datetime.timezone(datetime.timedelta(seconds=utcoffset), name)
+
+    def clear(self):
+        self._ids.clear()
+        self._zones.clear()